@@ -0,0 +1,538 @@
+"""
+Simulated hub for the HubLinker cog that runs without connecting to Discord.
+
+Builds a master and its slaves out of stand-in servers, roles and members,
+loads the cog on a fake bot that keeps role changes in memory (optionally
+with latency and injected 429s) and replays what Discord would send back.
+For each hub size it runs initial_linker, member joins, role edits,
+bursts of member updates and a backfill cut short by a restart, then
+reports the API calls made, the wall time and whether every slave ended up
+matching the master. It exits non-zero if one didn't, or if the cog never
+went idle.
+
+Run it from the root of your Red install (so `cogs.utils` can be imported):
+
+    python3 path/to/hublinker/benchmark.py --slaves 1 10 50 \\
+        --members 100 10000 --latency 0.05 --rate-limit 0.01
+
+Nothing is written to your data folder, the cog runs in a temp directory.
+"""
+import argparse
+import asyncio
+import copy
+import importlib.util
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import discord
+from tabulate import tabulate
+
+# hublinker.py does `from __main__ import send_cmd_help`
+
+
+async def send_cmd_help(ctx):
+    pass
+
+
+# What hublink gives its own role, plus the manage_roles an admin adds
+SQUID_PERMISSIONS = 36826127 | 0x10000000
+
+
+class StubResponse:
+    status = 429
+    reason = "Too Many Requests"
+
+
+class StubServer(discord.Server):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.roles = []
+        self._members = {}
+        self.me = None
+
+
+class StubMember:
+    __slots__ = ("id", "name", "server", "roles", "status")
+
+    def __init__(self, id, server, roles, status=discord.Status.online):
+        self.id = id
+        self.name = "member-" + id
+        self.server = server
+        self.roles = roles
+        self.status = status
+
+    def __copy__(self):
+        return StubMember(self.id, self.server, self.roles, self.status)
+
+
+class StubHTTP:
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def move_role_position(self, server_id, positions):
+        await self.bot._request("move")
+        server = self.bot.server_index[server_id]
+        positions = {p["id"]: p["position"] for p in positions}
+        for role in server.roles:
+            role.position = positions.get(role.id, role.position)
+
+    async def create_role(self, server_id):
+        await self.bot._request("create")
+        server = self.bot.server_index[server_id]
+        role = discord.Role(server=server, id=self.bot.next_id(),
+                            name="new role", position=1)
+        for r in server.roles[1:]:
+            r.position += 1
+        server.roles.append(role)
+        self.bot.dispatch("server_role_create", role)
+        return {"id": role.id, "name": role.name, "permissions": 0,
+                "position": role.position, "color": 0, "hoist": False,
+                "managed": False, "mentionable": False}
+
+
+class StubBot:
+    """Just enough of discord.Client for HubLinker.
+
+    Every request counts as an API call, waits `latency` seconds and fails
+    with a 429 `rate_limit` of the time. Successful changes are applied to
+    the cached objects and the matching events are dispatched, the same as
+    the gateway would.
+    """
+
+    def __init__(self, loop, latency=0, rate_limit=0, seed=0):
+        self.loop = loop
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rng = random.Random(seed)
+        self.servers = []
+        self.server_index = {}
+        self.cogs = {}
+        self.listeners = {}
+        self.calls = Counter()
+        self.http = StubHTTP(self)
+        self.ids = itertools.count(10**17)
+
+    def next_id(self):
+        return str(next(self.ids))
+
+    def add_server(self, server):
+        self.servers.append(server)
+        self.server_index[server.id] = server
+
+    def add_cog(self, cog):
+        self.cogs[type(cog).__name__] = cog
+
+    def add_listener(self, func, name):
+        self.listeners.setdefault(name, []).append(func)
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def dispatch(self, event, *args):
+        for func in self.listeners.get("on_" + event, ()):
+            discord.compat.create_task(func(*args))
+
+    async def _request(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_limit and self.rng.random() < self.rate_limit:
+            self.calls["429"] += 1
+            raise discord.HTTPException(StubResponse(),
+                                        "You are being rate limited.")
+
+    def _cached_role(self, server, role):
+        return discord.utils.get(server.roles, id=role.id)
+
+    def _set_member_roles(self, member, roles):
+        before = copy.copy(member)
+        everyone = member.server.roles[0]
+        member.roles = [everyone] + [r for r in roles if r != everyone]
+        self.dispatch("member_update", before, member)
+
+    async def create_role(self, server, **fields):
+        # Same as discord.py: the POST and the edit are separate requests
+        data = await self.http.create_role(server.id)
+        role = discord.Role(server=server, **data)
+        await self.edit_role(server, role, **fields)
+        return role
+
+    async def edit_role(self, server, role, **fields):
+        await self._request("edit")
+        cached = self._cached_role(server, role)
+        before = copy.copy(cached)
+        for target in (cached, role):
+            for name, value in fields.items():
+                setattr(target, name, value)
+            target.color = target.colour
+        self.dispatch("server_role_update", before, cached)
+
+    async def delete_role(self, server, role):
+        await self._request("delete")
+        cached = self._cached_role(server, role)
+        server.roles.remove(cached)
+        for member in server.members:
+            if cached in member.roles:
+                member.roles = [r for r in member.roles if r != cached]
+        self.dispatch("server_role_delete", cached)
+
+    async def add_roles(self, member, *roles):
+        await self._request("add")
+        new = [self._cached_role(member.server, r) for r in roles]
+        self._set_member_roles(member, member.roles[1:] +
+                               [r for r in new if r not in member.roles])
+
+    async def remove_roles(self, member, *roles):
+        await self._request("remove")
+        self._set_member_roles(member, [r for r in member.roles[1:]
+                                        if r not in roles])
+
+    async def replace_roles(self, member, *roles):
+        await self._request("replace")
+        roles = [self._cached_role(member.server, r) for r in roles]
+        self._set_member_roles(member, list(discord.utils._unique(
+            r for r in roles if r is not None)))
+
+
+def load_hublinker_module():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "hublinker.py")
+    spec = importlib.util.spec_from_file_location("hublinker", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def new_role(bot, server, name, position, **fields):
+    role = discord.Role(server=server, id=bot.next_id(), name=name,
+                        position=position, **fields)
+    server.roles.append(role)
+    return role
+
+
+def new_server(bot, name):
+    server = StubServer(bot.next_id(), name)
+    # @everyone shares the server's id
+    server.roles.append(discord.Role(server=server, id=server.id,
+                                     name="@everyone", position=0))
+    bot.add_server(server)
+    return server
+
+
+def add_squid(bot, server):
+    squid = new_role(bot, server, "Squid", len(server.roles),
+                     permissions=SQUID_PERMISSIONS)
+    server.me = StubMember("0", server, [server.roles[0], squid])
+
+
+def build_hub(bot, args, slave_count, member_count, rng):
+    master = new_server(bot, "master")
+    for i in range(args.roles):
+        new_role(bot, master, "role{}".format(i), i + 1,
+                 permissions=rng.randrange(1 << 20),
+                 color=rng.randrange(1 << 24), hoist=rng.random() < 0.1)
+    add_squid(bot, master)
+    master_roles = master.roles[1:args.roles + 1]
+
+    for _ in range(member_count):
+        member_id = bot.next_id()
+        count = rng.randint(0, min(args.member_roles, args.roles))
+        master._members[member_id] = StubMember(
+            member_id, master,
+            [master.roles[0]] + rng.sample(master_roles, count),
+            rng.choice((discord.Status.online, discord.Status.offline)))
+
+    # Slaves look like a hub that was linked a while ago and drifted: most
+    #   roles are there, some changed, some missing, plus a few strays.
+    slaves = []
+    for s in range(slave_count):
+        slave = new_server(bot, "slave{}".format(s))
+        for role in master_roles:
+            roll = rng.random()
+            if roll < 0.7:
+                new_role(bot, slave, role.name, len(slave.roles),
+                         permissions=role.permissions.value,
+                         color=role.colour.value, hoist=role.hoist)
+            elif roll < 0.8:
+                new_role(bot, slave, role.name, len(slave.roles),
+                         permissions=rng.randrange(1 << 20))
+        for i in range(args.strays):
+            new_role(bot, slave, "stray{}".format(i), len(slave.roles))
+        new_role(bot, slave, "Some Bot", len(slave.roles), managed=True)
+        add_squid(bot, slave)
+
+        copies = slave.roles[1:-2]
+        for member in master.members:
+            if rng.random() < args.overlap:
+                count = rng.randint(0, min(3, len(copies)))
+                slave._members[member.id] = StubMember(
+                    member.id, slave,
+                    [slave.roles[0]] + rng.sample(copies, count))
+        slaves.append(slave)
+    return master, slaves
+
+
+def check_hub(cog, master, slaves):
+    """Counts slave roles and members that don't match the master"""
+    errors = 0
+    master_roles = {r.id: r for r in master.roles if cog._syncable(r)}
+    for slave in slaves:
+        mapped = cog.role_map.get(slave.id, {})
+        copies = set(mapped.values())
+        slave_roles = {r.id: r for r in slave.roles}
+        for master_id, role in master_roles.items():
+            copy_role = slave_roles.get(mapped.get(master_id))
+            if copy_role is None or not cog._role_equality(copy_role, role):
+                errors += 1
+        # Roles hublink doesn't know about, apart from ours and managed ones
+        errors += sum(1 for r in slave.roles if r.id not in copies and
+                      cog._syncable(r) and not r.managed)
+
+        for member in master.members:
+            slave_member = slave.get_member(member.id)
+            if slave_member is None:
+                continue
+            want = set(mapped.get(r.id) for r in member.roles
+                       if r.id in master_roles)
+            have = set(r.id for r in slave_member.roles if r.id in copies)
+            if want != have:
+                errors += 1
+    return errors
+
+
+class Stuck(Exception):
+    pass
+
+
+def busy(cog):
+    return any(q.jobs or q.workers for q in cog.queues.values()) or \
+        cog.backfill_tasks or cog.member_bursts
+
+
+async def settle(cog, timeout):
+    """Waits until the cog has nothing left queued, debounced or running.
+    Dispatched events are tasks too, so it has to stay idle for a moment.
+    Raises Stuck with what is left if that takes over `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    idle = 0
+    while idle < 3:
+        if time.monotonic() > deadline:
+            stuck = ["{}: jobs {} running {} workers {}".format(
+                slave, list(q.jobs)[:5], list(q.running)[:5], len(q.workers))
+                for slave, q in cog.queues.items() if q.jobs or q.workers]
+            stuck += ["{}: backfill at {}".format(
+                slave, cog.backfill.get(slave))
+                for slave in cog.backfill_tasks]
+            if cog.member_bursts:
+                stuck.append("{} member bursts".format(
+                    len(cog.member_bursts)))
+            raise Stuck("still busy after {}s:\n\t{}".format(
+                timeout, "\n\t".join(stuck)))
+        await asyncio.sleep(0.01)
+        idle = 0 if busy(cog) else idle + 1
+
+
+async def run_initial_linker(bot, cog, master, slaves, args, rng):
+    await asyncio.gather(*[cog.initial_linker(master.id, s.id)
+                           for s in slaves])
+
+
+async def run_member_join(bot, cog, master, slaves, args, rng):
+    master_roles = master.roles[1:args.roles + 1]
+    for _ in range(args.joins):
+        member_id = bot.next_id()
+        count = rng.randint(1, min(args.member_roles, args.roles))
+        master._members[member_id] = StubMember(
+            member_id, master,
+            [master.roles[0]] + rng.sample(master_roles, count))
+        for slave in slaves:
+            member = StubMember(member_id, slave, [slave.roles[0]])
+            slave._members[member_id] = member
+            bot.dispatch("member_join", member)
+
+
+async def run_role_edit(bot, cog, master, slaves, args, rng):
+    for role in rng.sample(master.roles[1:args.roles + 1], args.edits):
+        before = copy.copy(role)
+        role.name += "-edited"
+        role.permissions = discord.Permissions(rng.randrange(1 << 20))
+        bot.dispatch("server_role_update", before, role)
+
+
+async def run_member_update(bot, cog, master, slaves, args, rng):
+    master_roles = master.roles[1:args.roles + 1]
+    members = rng.sample(list(master.members),
+                         min(args.updates, len(master._members)))
+    for member in members:
+        # A few role changes in a row, with presence flapping in between
+        for _ in range(3):
+            before = copy.copy(member)
+            member.roles = member.roles + [rng.choice(master_roles)]
+            member.roles = [member.roles[0]] + list(discord.utils._unique(
+                member.roles[1:]))
+            bot.dispatch("member_update", before, member)
+
+            before = copy.copy(member)
+            member.status = rng.choice((discord.Status.online,
+                                        discord.Status.idle))
+            bot.dispatch("member_update", before, member)
+        await asyncio.sleep(0)
+
+
+async def run_backfill_resume(bot, cog, master, slaves, args, rng):
+    """Knocks every slave member's roles off and backfills them, but kills
+    the backfill halfway the way a restart would: queued jobs are lost and
+    only what was saved to backfill.json survives. Resuming from that must
+    not skip anyone.
+    """
+    for slave in slaves:
+        for member in slave.members:
+            member.roles = [slave.roles[0]]
+    # Slow the queues down so jobs are still waiting when the cursor moves,
+    #   and cut in as soon as it has moved past the middle
+    for slave in slaves:
+        cog._queue(slave).set_pace(dict(cog.pace, RATE=400))
+        cog._start_backfill(master, slave)
+    middle = sorted(int(m.id) for m in master.members)[
+        len(master.members) // 2]
+    while any(cog.backfill.get(s.id, {}).get("CURSOR", middle) < middle
+              for s in slaves):
+        await asyncio.sleep(0.001)
+
+    for slave in slaves:
+        task = cog.backfill_tasks.pop(slave.id, None)
+        if task is not None:
+            task.cancel()
+        cog.queues.pop(slave.id).cancel()
+    await asyncio.sleep(0)
+    with open("data/hublinker/backfill.json") as f:
+        cog.backfill = json.load(f)
+    cog._resume_backfills()
+
+
+SCENARIOS = [
+    ("initial_linker", run_initial_linker),
+    ("member_join", run_member_join),
+    ("role_edit", run_role_edit),
+    ("member_update", run_member_update),
+    ("backfill_resume", run_backfill_resume),
+]
+
+
+def run_hub(hublinker, args, slave_count, member_count):
+    rng = random.Random(args.seed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = StubBot(loop, args.latency, args.rate_limit, args.seed)
+    master, slaves = build_hub(bot, args, slave_count, member_count, rng)
+
+    hublinker.setup(bot)
+    cog = bot.get_cog("HubLinker")
+    cog.pace.update({'CONCURRENCY': args.concurrency, 'RATE': args.rate,
+                     'BURST': args.burst})
+    cog.links = {master.id: {'ENABLED': True,
+                             'SLAVES': [s.id for s in slaves]}}
+    cog._index_links()
+
+    rows = []
+    for name, scenario in SCENARIOS:
+        bot.calls.clear()
+        start = time.perf_counter()
+        loop.run_until_complete(scenario(bot, cog, master, slaves, args, rng))
+        loop.run_until_complete(settle(cog, args.timeout))
+        elapsed = time.perf_counter() - start
+
+        errors = check_hub(cog, master, slaves)
+        calls = sum(n for call, n in bot.calls.items() if call != "429")
+        rows.append([slave_count, member_count, name, calls,
+                     bot.calls["create"], bot.calls["edit"],
+                     bot.calls["delete"], bot.calls["move"],
+                     bot.calls["replace"] + bot.calls["add"] +
+                     bot.calls["remove"], bot.calls["429"],
+                     "{:.2f}".format(elapsed),
+                     "ok" if errors == 0 else "{} off".format(errors)])
+
+    cog._HubLinker__unload()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    return rows
+
+
+def run(args):
+    hublinker = load_hublinker_module()
+    # Keep the waits the cog does between bursts and retries short
+    hublinker.MEMBER_DEBOUNCE = args.debounce
+    hublinker.MEMBER_DEBOUNCE_MAX = args.debounce * 5
+    hublinker.RETRY_BASE = args.retry_base
+
+    rows = []
+    for slave_count in args.slaves:
+        for member_count in args.members:
+            print("Running {} slaves, {} members...".format(slave_count,
+                                                            member_count))
+            rows.extend(run_hub(hublinker, args, slave_count, member_count))
+
+    print(tabulate(rows, headers=["Slaves", "Members", "Scenario", "Calls",
+                                  "Create", "Edit", "Delete", "Move",
+                                  "Member", "429s", "Wall (s)", "Correct"],
+                   tablefmt="psql"))
+    return all(row[-1] == "ok" for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--slaves", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--members", type=int, nargs="+",
+                        default=[100, 1000])
+    parser.add_argument("--roles", type=int, default=50,
+                        help="roles on the master")
+    parser.add_argument("--member-roles", type=int, default=5,
+                        help="max roles per master member")
+    parser.add_argument("--strays", type=int, default=5,
+                        help="roles on each slave that aren't on the master")
+    parser.add_argument("--overlap", type=float, default=0.8,
+                        help="share of master members in each slave")
+    parser.add_argument("--joins", type=int, default=20)
+    parser.add_argument("--edits", type=int, default=5)
+    parser.add_argument("--updates", type=int, default=100,
+                        help="members that get a burst of updates")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds each API call takes")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="share of API calls that get a 429")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="jobs started per second per slave")
+    parser.add_argument("--burst", type=int, default=100)
+    parser.add_argument("--debounce", type=float, default=0.05)
+    parser.add_argument("--retry-base", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="seconds a scenario may take to go idle")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Let `cogs.utils` resolve from the Red root, then work in a scratch dir
+    #   so the cog's data files go somewhere harmless.
+    sys.path.insert(0, os.getcwd())
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.mkdir("data")
+        try:
+            ok = run(args)
+        except Stuck as e:
+            print(e)
+            ok = False
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,159 @@ import discord
 from discord.ext import commands
 from cogs.utils import checks
 from cogs.utils.dataIO import fileIO
+from cogs.utils.chat_formatting import box
 from __main__ import send_cmd_help
 import os
 import logging
-import copy
+import asyncio
+import bisect
+import json
+import time
+from collections import OrderedDict, deque
 
 log = logging.getLogger("red.hublinker")
 log.setLevel(logging.WARNING)
 
+# Role changes each slave may have in flight at once, how many may start per
+#   second and how many may start back to back after the queue sat idle.
+#   `hublink pace` changes these for the running bot.
+DEFAULT_PACE = {'CONCURRENCY': 2, 'RATE': 1.0, 'BURST': 5}
+# A job that hits a rate limit or a Discord error is retried this many times,
+#   waiting RETRY_BASE, 2 * RETRY_BASE, 4 * RETRY_BASE... seconds in between.
+RETRY_LIMIT = 5
+RETRY_BASE = 2
+# Master members looked at per backfill step. The next step waits until the
+#   slave's queue has fewer jobs than this waiting.
+BACKFILL_PAGE = 100
+# Role changes to one master member are gathered until none have come in for
+#   MEMBER_DEBOUNCE seconds, or for MEMBER_DEBOUNCE_MAX seconds at most.
+MEMBER_DEBOUNCE = 2
+MEMBER_DEBOUNCE_MAX = 10
+# Seconds between checks of every slave for roles that drifted from the
+#   master, and the longest a check runs before letting other tasks go.
+DRIFT_INTERVAL = 60 * 60
+DRIFT_SLICE = 0.02
+# One JSON object per line, appended before and after every role change an
+#   init makes, so an init cut short by a restart can be finished on startup.
+JOURNAL = 'data/hublinker/journal.json'
+
+
+class SlaveQueue:
+    """Role changes waiting to go out to one slave.
+
+    Jobs are keyed, so queueing the same member or role again while it is
+    still waiting is a no-op. Jobs work out what to change when they run,
+    which means the one that does run picks up everything that was queued.
+    """
+
+    def __init__(self, pace):
+        self.jobs = OrderedDict()
+        # Keys of the jobs workers are running right now
+        self.running = set()
+        self.workers = set()
+        # Held while a job creates a role, so two jobs don't both make it
+        self.create_lock = asyncio.Lock()
+        self.set_pace(pace)
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        # Finish times of recent jobs, for throughput
+        self.finished = deque(maxlen=1000)
+
+    def put(self, key, func, *args):
+        if key in self.jobs:
+            self.coalesced += 1
+            return
+        self.jobs[key] = (func, args)
+        if len(self.workers) < min(self.concurrency, len(self.jobs)):
+            worker = discord.compat.create_task(self._work())
+            self.workers.add(worker)
+            worker.add_done_callback(self.workers.discard)
+
+    def pending(self, key):
+        """Whether a job with this key is waiting or running"""
+        return key in self.jobs or key in self.running
+
+    def cancel(self):
+        self.jobs.clear()
+        for worker in list(self.workers):
+            worker.cancel()
+
+    def set_pace(self, pace):
+        self.concurrency = pace['CONCURRENCY']
+        self.rate = pace['RATE']
+        self.burst = pace['BURST']
+
+    def throughput(self, window=60):
+        """Jobs finished per minute over the last window seconds"""
+        since = time.monotonic() - window
+        return sum(1 for t in self.finished if t > since) * 60 / window
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def call(self, func, *args, **kwargs):
+        """Makes one request at this queue's pace, retrying it on rate limits
+        and Discord errors. Whatever the last attempt raised is raised.
+        """
+        for attempt in range(RETRY_LIMIT + 1):
+            await self._take_token()
+            try:
+                return await func(*args, **kwargs)
+            except (discord.Forbidden, discord.NotFound):
+                raise
+            except discord.HTTPException as e:
+                status = getattr(e.response, 'status', None)
+                if attempt == RETRY_LIMIT or \
+                        (status != 429 and (status is None or status < 500)):
+                    raise
+                log.debug('hub request got {}, retrying'.format(status))
+                self.retried += 1
+                # Whatever we had saved up clearly wasn't there
+                self.tokens = 0
+                await asyncio.sleep(RETRY_BASE * 2 ** attempt)
+
+    async def _run(self, key, func, args):
+        try:
+            await self.call(func, *args)
+        except discord.HTTPException as e:
+            log.warning('hub job {} failed: {}'.format(key, e))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('hub job {} failed'.format(key))
+        else:
+            self.completed += 1
+            self.finished.append(time.monotonic())
+            return
+        self.failed += 1
+
+    async def _work(self):
+        try:
+            while self.jobs:
+                key, (func, args) = self.jobs.popitem(last=False)
+                self.running.add(key)
+                try:
+                    await self._run(key, func, args)
+                finally:
+                    self.running.discard(key)
+        finally:
+            # Before the done callback would, or a put() in between could
+            #   count us and leave its job without a worker
+            self.workers.discard(asyncio.Task.current_task())
+
 
 class HubLinker:
     """This will sync all roles and assignments from ONE master server to all
@@ -21,11 +166,75 @@ class HubLinker:
     def __init__(self, bot):
         self.bot = bot
         self.links = fileIO('data/hublinker/links.json', 'load')
+        # Which slave role is the copy of which master role, so renames and
+        #   edits on the master don't lose track of them.
+        #   {slave id: {master role id: slave role id}}
+        self.role_map = fileIO('data/hublinker/roles.json', 'load')
+        # {server id: {role id: Role}}, built on use and dropped whenever a
+        #   role is created or deleted on that server.
+        self.role_cache = {}
+
+        # Lookups the event handlers need, kept current by the links
+        #   commands and the server events instead of walking bot.servers.
+        #   {slave id: master id}, {role id: server id}, {server id: Server}
+        self.slave_masters = {}
+        self.role_servers = {}
+        self.server_index = {}
+        self._index_links()
+        self._index_servers()
+
+        self.pace = DEFAULT_PACE.copy()
+        self.pace.update(fileIO('data/hublinker/settings.json', 'load'))
+        # {slave id: SlaveQueue}
+        self.queues = {}
+        # Master members with role updates coming in, see member_update.
+        #   {(master id, member id): [role ids before, first update, timer]}
+        self.member_bursts = {}
+
+        # Member backfills still to finish, by member id order so they can
+        #   pick up where they left off after a restart.
+        #   {slave id: {'MASTER': id, 'CURSOR': last member id done,
+        #               'DONE': members done, 'TOTAL': members}}
+        self.backfill = fileIO('data/hublinker/backfill.json', 'load')
+        # {slave id: Task} and {slave id: (start time, DONE at start)}
+        self.backfill_tasks = {}
+        self.backfill_runs = {}
+        # Inits that were running when the bot went down, read back from the
+        #   journal. {slave id: {'MASTER': id, 'ROLES': {master role id:
+        #   slave role id}}}, and the slaves with an init running now.
+        self.unfinished = self._read_journal()
+        self.syncing = set()
+        self._compact_journal()
+        if self.bot.servers:
+            self._resume_backfills()
+            self._resume_syncs()
+
+        # {slave id: (time, roles off, members off)} from the last check
+        self.drift = {}
+        self.drift_task = discord.compat.create_task(self.drift_checker())
+
+    def __unload(self):
+        for queue in self.queues.values():
+            queue.cancel()
+        for task in self.backfill_tasks.values():
+            task.cancel()
+        for burst in self.member_bursts.values():
+            burst[2].cancel()
+        self.drift_task.cancel()
+
+    def save_backfill(self):
+        fileIO('data/hublinker/backfill.json', 'save', self.backfill)
 
     def save_links(self):
         fileIO('data/hublinker/links.json', 'save', self.links)
         log.debug('saved hublinker links:\n\t{}'.format(self.links))
 
+    def save_pace(self):
+        fileIO('data/hublinker/settings.json', 'save', self.pace)
+
+    def save_role_map(self):
+        fileIO('data/hublinker/roles.json', 'save', self.role_map)
+
     @commands.group(no_pm=True, pass_context=True)
     @checks.serverowner_or_permissions(manage_roles=True)
     async def hublink(self, ctx):
@@ -48,23 +257,24 @@ class HubLinker:
         server = ctx.message.server
         sid = server.id
 
-        all_slaves = []
-        for master in self.links:
-            for slave in self.links[master]['SLAVES']:
-                all_slaves.append(slave)
-
         if sid in self.links:
+            for slave in self.links[sid]['SLAVES']:
+                self.role_map.pop(slave, None)
+                self.unfinished.pop(slave, None)
+                self._stop_backfill(slave)
             del self.links[sid]
             await self.bot.say("Master removed.")
-        elif sid in all_slaves:
-            for master in self.links:
-                if sid in self.links[master]['SLAVES']:
-                    self.links[master]["SLAVES"].remove(sid)
-                    await self.bot.say("Slave removed.")
-                    break
+        elif sid in self.slave_masters:
+            self.links[self.slave_masters[sid]]["SLAVES"].remove(sid)
+            self.role_map.pop(sid, None)
+            self.unfinished.pop(sid, None)
+            self._stop_backfill(sid)
+            await self.bot.say("Slave removed.")
         else:
             await self.bot.say('This server is neither a master nor a slave.')
+        self._index_links()
         self.save_links()
+        self.save_role_map()
 
     @hublink.command(no_pm=True, pass_context=True)
     async def slave(self, ctx, master_server_id):
@@ -79,6 +289,7 @@ class HubLinker:
             return
         self.links[master_server_id]['SLAVES'].append(server.id)
         log.debug('slave {} to master {}'.format(server.id, master_server_id))
+        self._index_links()
         self.save_links()
 
     @hublink.command(no_pm=True, pass_context=True)
@@ -112,11 +323,6 @@ class HubLinker:
         server = ctx.message.server
         sid = server.id
 
-        all_slaves = []
-        for master in self.links:
-            for slave in self.links[master]['SLAVES']:
-                all_slaves.append(slave)
-
         if sid in self.links:
             for slave in self.links[sid]['SLAVES']:
                 try:
@@ -126,33 +332,170 @@ class HubLinker:
                                        " ALL OTHERS on ALL slave servers.")
                 else:
                     await self.initial_linker(sid, slave)
-        elif sid in all_slaves:
-            for master in self.links:
-                if sid in self.links[master]['SLAVES']:
-                    ms = discord.utils.get(self.bot.servers, id=master)
-                    if ms is None:
-                        return
+        elif sid in self.slave_masters:
+            master = self.slave_masters[sid]
+            ms = self._server_from_id(master)
+            if ms is None:
+                return
 
-                    try:
-                        self._slave_role_check(ms)
-                    except:
-                        await self.bot.say(
-                            "You MUST put the 'Squid' role above"
-                            " ALL OTHERS on ALL slave servers.")
-                    else:
-                        log.debug('forcing init on slave '
-                                  '{} from master {}'.format(sid, master))
-                        await self.initial_linker(master, sid)
-                        break
+            try:
+                self._slave_role_check(ms)
+            except:
+                await self.bot.say("You MUST put the 'Squid' role above"
+                                   " ALL OTHERS on ALL slave servers.")
+            else:
+                log.debug('forcing init on slave '
+                          '{} from master {}'.format(sid, master))
+                await self.initial_linker(master, sid)
         else:
             await self.bot.say('This server is neither a master nor a slave.')
 
-    async def initial_linker(self, master, slave):
-        master = discord.utils.get(self.bot.servers, id=master)
-        slave = discord.utils.get(self.bot.servers, id=slave)
-        if master is None or slave is None:
+    @hublink.command(no_pm=True, pass_context=True)
+    async def plan(self, ctx):
+        """Shows what `hublink init` would change without changing it."""
+        server = ctx.message.server
+        sid = server.id
+
+        if sid in self.links:
+            pairs = [(sid, slave) for slave in self.links[sid]['SLAVES']]
+        elif sid in self.slave_masters:
+            pairs = [(self.slave_masters[sid], sid)]
+        else:
+            pairs = []
+        if not pairs:
+            await self.bot.say('This server is neither a master nor a slave.')
             return
 
+        msg = []
+        for master, slave in pairs:
+            plan = await self.initial_linker(master, slave, dry_run=True)
+            if plan is None:
+                msg.append('{}: server not found'.format(slave))
+                continue
+            msg.append('{}: {} to create, {} to edit, {} to delete, {}'
+                       ' reorder, {} members to update ({} operations)'.format(
+                           plan['SLAVE'].name, len(plan['CREATE']),
+                           len(plan['EDIT']), len(plan['DELETE']),
+                           1 if plan['REORDER'] else 0, plan['MEMBERS'],
+                           self._plan_size(plan)))
+        await self.bot.say(box('\n'.join(msg)))
+
+    @hublink.command(no_pm=True, pass_context=True)
+    async def pace(self, ctx, concurrency: int=None, rate: float=None,
+                   burst: int=None):
+        """Sets how fast role changes go out to each slave.
+
+        concurrency: changes in flight at once per slave
+        rate: changes started per second per slave
+        burst: changes that may start back to back after a quiet spell"""
+        if ctx.message.author.id != self.bot.settings.owner:
+            return
+        if concurrency is None:
+            await self.bot.say('{CONCURRENCY} at once, {RATE}/s, bursts of'
+                               ' {BURST}.'.format(**self.pace))
+            return
+        if concurrency < 1 or (rate is not None and rate <= 0) or \
+                (burst is not None and burst < 1):
+            await self.bot.say('Those need to be positive.')
+            return
+
+        self.pace['CONCURRENCY'] = concurrency
+        if rate is not None:
+            self.pace['RATE'] = rate
+        if burst is not None:
+            self.pace['BURST'] = burst
+        for queue in self.queues.values():
+            queue.set_pace(self.pace)
+        self.save_pace()
+        await self.bot.say('{CONCURRENCY} at once, {RATE}/s, bursts of'
+                           ' {BURST}.'.format(**self.pace))
+
+    @hublink.command(no_pm=True, pass_context=True)
+    async def status(self, ctx):
+        """Shows the role changes waiting to go out to this hub's slaves."""
+        sid = ctx.message.server.id
+        if sid in self.links:
+            slaves = self.links[sid]['SLAVES']
+        elif sid in self.slave_masters:
+            slaves = [sid]
+        else:
+            slaves = []
+        if not slaves:
+            await self.bot.say('This server is neither a master nor a slave.')
+            return
+
+        msg = []
+        for slave in slaves:
+            server = self._server_from_id(slave)
+            name = slave if server is None else server.name
+            queue = self.queues.get(slave)
+            if queue is None:
+                msg.append('{}: idle'.format(name))
+            else:
+                msg.append('{}: {} queued, {} running, {} done, {} failed, {}'
+                           ' retried, {} merged, {:.1f}/min'.format(
+                               name, len(queue.jobs), len(queue.running),
+                               queue.completed, queue.failed, queue.retried,
+                               queue.coalesced, queue.throughput()))
+            if slave in self.syncing:
+                msg.append('    init running')
+            elif slave in self.unfinished:
+                msg.append('    init did not finish, it runs again when the'
+                           ' bot reconnects or either server comes back')
+            if slave in self.drift:
+                when, roles, members, strays = self.drift[slave]
+                msg.append('    drift check {}m ago: {} roles, {} members'
+                           ' off, {} unmapped roles'.format(
+                               int(time.time() - when) // 60, roles, members,
+                               strays))
+            if slave in self.backfill:
+                done, total, left = self._backfill_progress(slave)
+                if left is None:
+                    eta = 'unknown'
+                else:
+                    eta = '{}m {}s'.format(*divmod(int(left), 60))
+                msg.append('    backfill: {}/{} members checked, {} to'
+                           ' go{}'.format(done, total, eta,
+                                          '' if slave in self.backfill_tasks
+                                          else ' (paused)'))
+        await self.bot.say(box('\n'.join(msg)))
+
+    async def initial_linker(self, master, slave, dry_run=False):
+        """Brings the slave's roles in line with the master's and returns the
+        plan that did it. With dry_run nothing is changed on the slave.
+        """
+        master = self._server_from_id(master)
+        slave = self._server_from_id(slave)
+        if master is None or slave is None:
+            return None
+
+        plan = self._plan_roles(master, slave)
+        if dry_run:
+            return plan
+
+        self.syncing.add(slave.id)
+        self._journal('BEGIN', slave.id, MASTER=master.id,
+                      CREATE=[r.id for r in plan['CREATE']],
+                      EDIT=[r.id for r, _ in plan['EDIT']],
+                      DELETE=[r.id for r in plan['DELETE']],
+                      REORDER=plan['REORDER'])
+        try:
+            await self._sync_roles(master, slave, plan)
+        except Exception:
+            # Keep it in the journal, the next startup gives it another go
+            self.unfinished[slave.id] = {
+                'MASTER': master.id,
+                'ROLES': {mid: r.id for mid, r in plan['PAIRS'].items()}}
+            raise
+        finally:
+            self.syncing.discard(slave.id)
+        self._journal('END', slave.id)
+        self._compact_journal()
+
+        self._start_backfill(master, slave)
+        return plan
+
+    async def _sync_roles(self, master, slave, plan):
         my_role = discord.utils.find(lambda r: r.name.lower() == "squid",
                                      slave.roles)
         if my_role is None:
@@ -160,71 +503,404 @@ class HubLinker:
             role_dict['permissions'] = \
                 discord.Permissions(permissions=36826127)
             role_dict['name'] = "Squid"
-            my_server_role = await self.bot.create_role(slave, **role_dict)
-            await self.bot.add_roles(slave.me, my_server_role)
+            my_role = await self.bot.create_role(slave, **role_dict)
+            await self.bot.add_roles(slave.me, my_role)
+        plan['SQUID'] = my_role
+
+        log.debug('role plan for {}: {} operations'.format(
+            slave.id, self._plan_size(plan)))
 
-        log.debug('Slave roles:\n\t{}'.format(
-            [role.name for role in slave.roles]))
+        await self._apply_roles(plan)
+        self.role_map[slave.id] = {mid: r.id
+                                   for mid, r in plan['PAIRS'].items()}
+        self.save_role_map()
 
-        await self._delete_all_roles(slave)
+    async def _backfill(self, master, slave):
+        """Walks every master member in id order and queues the ones whose
+        slave roles are off, a page at a time so the queue never balloons.
+        The saved cursor only moves past a page once every job it queued has
+        run, so a restart picks up from the first member not yet synced.
+        """
+        state = self.backfill[slave.id]
+        queue = self._queue(slave)
+        ids = sorted(int(m.id) for m in master.members)
+        start = bisect.bisect_right(ids, state['CURSOR'])
+        state['TOTAL'] = len(ids)
+        state['DONE'] = start
+        self.backfill_runs[slave.id] = (time.monotonic(), start)
+        log.debug('backfilling {} from {}, {}/{} done'.format(
+            slave.id, master.id, start, len(ids)))
 
-        log.debug('Slave roles:\n\t{}'.format(
-            [role.name for role in slave.roles]))
+        # (last member id, job keys) of the pages not finished yet
+        pages = deque()
 
-        await self._create_all_roles(slave, master)
+        def advance():
+            moved = False
+            while pages and not any(queue.pending(k) for k in pages[0][1]):
+                state['CURSOR'] = pages.popleft()[0]
+                moved = True
+            return moved
 
-        # We only really care about the online people, this way we *hopefully*
-        # don't get ourselves rate-limited on large servers.
+        for i in range(start, len(ids), BACKFILL_PAGE):
+            page = ids[i:i + BACKFILL_PAGE]
+            keys = []
+            for member_id in page:
+                member_id = str(member_id)
+                master_member = master.get_member(member_id)
+                slave_member = slave.get_member(member_id)
+                if master_member is None or slave_member is None:
+                    continue
+                if self._member_roles(master_member, slave_member) is not None:
+                    keys.append(self._queue_member(master, slave, member_id))
+            pages.append((page[-1], keys))
 
-        online_master_members = [m for m in master.members
-                                 if m.status == discord.Status.online]
-        omm_withrole = [m for m in online_master_members if len(m.roles) > 1]
-        ommwr_in_slave = [m for m in omm_withrole if m in slave.members]
+            while len(queue.jobs) > BACKFILL_PAGE:
+                await asyncio.sleep(1)
+            state['DONE'] = i + len(page)
+            advance()
+            self.save_backfill()
+            # Let everything else have a go between pages
+            await asyncio.sleep(0)
 
-        log.debug('members to give role to RN:\n\t{}'.format(
-            [m.name for m in ommwr_in_slave]))
+        while pages:
+            if advance():
+                self.save_backfill()
+            else:
+                await asyncio.sleep(1)
+        del self.backfill[slave.id]
+        self.save_backfill()
+        log.info('backfill of {} from {} finished'.format(slave.id,
+                                                          master.id))
 
-        for m in ommwr_in_slave:
-            slave_member = discord.utils.get(slave.members, id=m.id)
-            to_add = []
-            for mrole in m.roles:
-                if mrole.name.lower() == "@everyone" \
-                        or mrole.name.lower() == "squid":
-                    continue
-                log.debug(self._matching_role(slave, mrole))
-                to_add.append(self._matching_role(slave, mrole))
-            log.debug('adding roles to {0.name} on {1.id}:\n\t{2}'.format(
-                slave_member, slave, [r.name for r in to_add]))
-            discord.compat.create_task(
-                self.bot.add_roles(slave_member, *to_add))
-
-    async def _delete_all_roles(self, server):
-        roles = copy.deepcopy(server.roles)
-        for role in roles:
-            if role.name.lower() == "@everyone" or \
-                    role.name.lower() == "squid":
-                log.debug('Skipping delete role {}'.format(role.name))
+    async def _check_drift(self, master, slave):
+        """Compares fingerprints of the role table and of every member's
+        copied roles between master and slave, and queues what differs.
+        Slave roles that aren't a copy of anything are only counted, init
+        is what deletes those.
+        Returns (roles queued, members queued, unmapped slave roles).
+        """
+        queue = self._queue(slave)
+        mapped = self.role_map.get(slave.id, {})
+
+        master_table = {r.id: self._role_fingerprint(r) for r in master.roles
+                        if self._syncable(r)}
+        slave_table = {}
+        for master_role_id, role_id in mapped.items():
+            copy = self._role_from_id(slave, role_id)
+            if copy is not None:
+                slave_table[master_role_id] = self._role_fingerprint(copy)
+
+        roles = 0
+        if hash(frozenset(master_table.items())) != \
+                hash(frozenset(slave_table.items())):
+            for master_role_id in set(master_table) | set(slave_table):
+                if master_table.get(master_role_id) != \
+                        slave_table.get(master_role_id):
+                    self._queue_role(master, slave, master_role_id)
+                    roles += 1
+
+        copies = set(mapped.values())
+        # Left behind by a copy that went wrong, or added on the slave
+        strays = sum(1 for r in slave.roles if r.id not in copies and
+                     self._syncable(r) and not r.managed)
+
+        members = 0
+        started = time.monotonic()
+        for i, master_member in enumerate(list(master.members)):
+            if i % 100 == 0 and time.monotonic() - started > DRIFT_SLICE:
+                # Don't hog the loop, and don't flood the queue either
+                await asyncio.sleep(0)
+                while len(queue.jobs) > BACKFILL_PAGE:
+                    await asyncio.sleep(1)
+                started = time.monotonic()
+
+            slave_member = slave.get_member(master_member.id)
+            if slave_member is None:
                 continue
-            await self.bot.delete_role(server, role)
-            log.debug('deleted role {} from {}'.format(role.name, server.name))
+            want = hash(frozenset(mapped[r.id] for r in master_member.roles
+                                  if r.id in mapped and self._syncable(r)))
+            have = hash(frozenset(r.id for r in slave_member.roles
+                                  if r.id in copies))
+            if want != have:
+                self._queue_member(master, slave, master_member.id)
+                members += 1
+        return roles, members, strays
+
+    def _backfill_progress(self, slave_id):
+        """(done, total, seconds left or None) for a backfill"""
+        state = self.backfill[slave_id]
+        done, total = state['DONE'], state['TOTAL']
+        if slave_id not in self.backfill_runs:
+            return done, total, None
+        started, start_done = self.backfill_runs[slave_id]
+        elapsed = time.monotonic() - started
+        if done <= start_done or elapsed <= 0:
+            return done, total, None
+        return done, total, (total - done) * elapsed / (done - start_done)
 
-    async def _create_all_roles(self, slave, master):
-        for role in master.roles:
-            if role.name.lower() == "@everyone" or \
-                    role.name.lower() == "squid":
+    def _resume_backfills(self):
+        for slave_id, state in self.backfill.items():
+            if slave_id in self.backfill_tasks:
                 continue
+            master = self._server_from_id(state['MASTER'])
+            slave = self._server_from_id(slave_id)
+            if master is not None and slave is not None:
+                self._start_backfill(master, slave, restart=False)
+
+    def _journal_line(self, op, slave_id, **data):
+        data.update(OP=op, SLAVE=slave_id, TIME=int(time.time()))
+        return json.dumps(data) + '\n'
+
+    def _journal(self, op, slave_id, **data):
+        """Appends one entry to the journal and waits for it to hit the disk"""
+        with open(JOURNAL, 'a', encoding='utf-8') as f:
+            f.write(self._journal_line(op, slave_id, **data))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_journal(self):
+        """Replays the journal into the inits that began and never ended,
+        with the roles they had already created.
+        """
+        unfinished = {}
+        if not os.path.exists(JOURNAL):
+            return unfinished
+        with open(JOURNAL, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Cut off by the crash, whatever it was never happened
+                    continue
+                slave, op = entry['SLAVE'], entry['OP']
+                if op == 'BEGIN':
+                    unfinished[slave] = {'MASTER': entry['MASTER'],
+                                         'ROLES': {}}
+                elif op == 'END':
+                    unfinished.pop(slave, None)
+                elif op == 'CREATE' and slave in unfinished:
+                    unfinished[slave]['ROLES'][entry['ROLE']] = entry['COPY']
+        return unfinished
+
+    def _compact_journal(self):
+        """Rewrites the journal down to the inits that are left to finish.
+        A running init still needs its own entries, so that waits for it.
+        """
+        if self.syncing:
+            return
+        lines = []
+        for slave_id, state in self.unfinished.items():
+            lines.append(self._journal_line('BEGIN', slave_id,
+                                            MASTER=state['MASTER']))
+            lines.extend(self._journal_line('CREATE', slave_id, ROLE=role_id,
+                                            COPY=copy_id)
+                         for role_id, copy_id in state['ROLES'].items())
+        # Write then rename so a crash mid-write keeps the old journal
+        tmp_path = JOURNAL + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, JOURNAL)
+
+    def _resume_syncs(self):
+        """Runs interrupted inits again. Roles they had created are mapped
+        first so the new plan picks them up instead of making more.
+        """
+        for slave_id, state in list(self.unfinished.items()):
+            if slave_id in self.syncing:
+                continue
+            if self.slave_masters.get(slave_id) != state['MASTER']:
+                # Unlinked since, nothing left to finish
+                del self.unfinished[slave_id]
+                continue
+            master = self._server_from_id(state['MASTER'])
+            slave = self._server_from_id(slave_id)
+            if master is None or slave is None:
+                continue
+
+            self.role_map.setdefault(slave_id, {}).update(state['ROLES'])
+            self.save_role_map()
+            del self.unfinished[slave_id]
+            # Counts as running from here, so compacting can't drop it from
+            #   the journal before the init writes its own entries
+            self.syncing.add(slave_id)
+            log.info('resuming interrupted init of {} from {}'.format(
+                slave_id, master.id))
+            discord.compat.create_task(self._resume_sync(master.id,
+                                                         slave_id))
+        self._compact_journal()
+
+    async def _resume_sync(self, master_id, slave_id):
+        try:
+            await self.initial_linker(master_id, slave_id)
+        finally:
+            self.syncing.discard(slave_id)
+
+    def _stop_backfill(self, slave_id):
+        task = self.backfill_tasks.pop(slave_id, None)
+        if task is not None:
+            task.cancel()
+        if self.backfill.pop(slave_id, None) is not None:
+            self.save_backfill()
+
+    def _start_backfill(self, master, slave, restart=True):
+        if restart or slave.id not in self.backfill:
+            self.backfill[slave.id] = {'MASTER': master.id, 'CURSOR': 0,
+                                       'DONE': 0,
+                                       'TOTAL': len(master.members)}
+            self.save_backfill()
+        old = self.backfill_tasks.pop(slave.id, None)
+        if old is not None:
+            old.cancel()
+
+        task = discord.compat.create_task(self._backfill(master, slave))
+        self.backfill_tasks[slave.id] = task
+
+        def done(task):
+            if self.backfill_tasks.get(slave.id) is task:
+                del self.backfill_tasks[slave.id]
+                self.backfill_runs.pop(slave.id, None)
+            if not task.cancelled() and task.exception() is not None:
+                log.error('backfill of {} failed'.format(slave.id),
+                          exc_info=task.exception())
+        task.add_done_callback(done)
+
+    def _plan_roles(self, master, slave):
+        """Works out the smallest set of role changes that makes the slave
+        match the master.
+
+        Slave roles are paired with the master role they were copied from,
+        then with master roles that look exactly the same, then by name.
+        Pairs that differ get edited, unpaired master roles get created and
+        unpaired slave roles get deleted. REORDER says whether the positions
+        need fixing up afterwards.
+        """
+        master_roles = sorted((r for r in master.roles if self._syncable(r)),
+                              key=lambda r: r.position)
+        spare = [r for r in slave.roles if self._syncable(r)]
+
+        pairs = {}
+        mapped = self.role_map.get(slave.id, {})
+        for role in master_roles:
+            found = discord.utils.get(spare, id=mapped.get(role.id))
+            if found is not None:
+                pairs[role.id] = found
+                spare.remove(found)
+
+        for match in (self._role_equality, self._same_name):
+            for role in master_roles:
+                if role.id in pairs:
+                    continue
+                found = discord.utils.find(lambda r: match(r, role), spare)
+                if found is not None:
+                    pairs[role.id] = found
+                    spare.remove(found)
+
+        plan = {'SLAVE': slave, 'SQUID': None, 'PAIRS': pairs}
+        plan['CREATE'] = [r for r in master_roles if r.id not in pairs]
+        plan['EDIT'] = [(pairs[r.id], r) for r in master_roles
+                        if r.id in pairs and
+                        not self._role_equality(pairs[r.id], r)]
+        plan['DELETE'] = [r for r in spare if not r.managed]
+        plan['ORDER'] = master_roles
+
+        current = [pairs[r.id].position for r in master_roles
+                   if r.id in pairs]
+        plan['REORDER'] = bool(plan['CREATE']) or current != sorted(current)
+
+        plan['MEMBERS'] = 0
+        for m in master.members:
+            slave_member = slave.get_member(m.id)
+            if slave_member is not None and \
+                    self._missing_roles(m, slave_member, pairs):
+                plan['MEMBERS'] += 1
+        return plan
+
+    def _plan_size(self, plan):
+        return len(plan['CREATE']) + len(plan['EDIT']) + \
+            len(plan['DELETE']) + (1 if plan['REORDER'] else 0) + \
+            plan['MEMBERS']
+
+    async def _apply_roles(self, plan):
+        slave = plan['SLAVE']
+        pairs = plan['PAIRS']
+        # Paced and retried like the queued jobs
+        call = self._queue(slave).call
+
+        for role in plan['DELETE']:
+            await call(self.bot.delete_role, slave, role)
+            self._journal('DELETE', slave.id, COPY=role.id)
+            log.debug('deleted role {} from {}'.format(role.name, slave.name))
+
+        for slave_role, role in plan['EDIT']:
+            await call(self.bot.edit_role, slave, slave_role,
+                       **self._explode_role(role))
+            self._journal('EDIT', slave.id, ROLE=role.id, COPY=slave_role.id)
+            log.debug('edited role {} on {}'.format(role.name, slave.name))
+
+        for role in plan['CREATE']:
             roleattrs = self._explode_role(role)
-            await self.bot.create_role(slave, **roleattrs)
+            # Create and edit separately so a retried edit can't leave a
+            #   second "new role" behind
+            data = await call(self.bot.http.create_role, slave.id)
+            pairs[role.id] = discord.Role(server=slave, **data)
+            # Without this a restart would make the role a second time
+            self._journal('CREATE', slave.id, ROLE=role.id,
+                          COPY=pairs[role.id].id)
+            await call(self.bot.edit_role, slave, pairs[role.id], **roleattrs)
             log.debug('created role {} on {}'.format(role.name, slave.name) +
                       ' with attrs:\n\t{}'.format(roleattrs))
 
+        if plan['REORDER']:
+            await self._order_roles(plan)
+            self._journal('REORDER', slave.id)
+
+    async def _order_roles(self, plan):
+        """Puts every slave role in the master's order with one request.
+        Roles we couldn't delete sit between those and our own role on top.
+        """
+        slave = plan['SLAVE']
+        ordered = [plan['PAIRS'][r.id] for r in plan['ORDER']]
+        synced = set(r.id for r in ordered)
+        deleted = set(r.id for r in plan['DELETE'])
+        squid = plan['SQUID']
+
+        kept = sorted((r for r in slave.roles if not r.is_everyone and
+                       r.id not in synced and r.id not in deleted and
+                       (squid is None or r.id != squid.id)),
+                      key=lambda r: r.position)
+        ordered += kept
+        if squid is not None:
+            ordered.append(squid)
+
+        payload = [{'id': r.id, 'position': i}
+                   for i, r in enumerate(ordered, 1)]
+        await self._queue(slave).call(self.bot.http.move_role_position,
+                                      slave.id, payload)
+        log.debug('reordered {} roles on {}'.format(len(payload), slave.id))
+
+    async def _copy_role(self, slave, role):
+        """Creates the slave's copy of a master role and remembers it"""
+        data = await self.bot.http.create_role(slave.id)
+        slave_role = discord.Role(server=slave, **data)
+        # Mapped before the edit so a retried job finds this role instead of
+        #   making another one
+        self._map_role(slave, role, slave_role)
+        # The server's role list only catches up once Discord tells us about
+        #   the new role, until then look it up from here.
+        self.role_cache.setdefault(slave.id, {})[slave_role.id] = slave_role
+        await self._queue(slave).call(self.bot.edit_role, slave, slave_role,
+                                      **self._explode_role(role))
+        return slave_role
+
     def _exists_and_enabled(self, sid):
         if sid in self.links and self.links[sid]['ENABLED']:
             return True
         return False
 
     def _has_manage_role(self, sid):
-        server = discord.utils.get(self.bot.servers, id=sid)
+        server = self._server_from_id(sid)
         if server is None:
             return False
         my_roles = server.me.roles
@@ -235,8 +911,29 @@ class HubLinker:
         return False
 
     def _get_server_from_role(self, role):
-        return discord.utils.find((lambda s: role in s.roles),
-                                  self.bot.servers)
+        return self._server_from_id(self.role_servers.get(role.id))
+
+    def _index_links(self):
+        self.slave_masters = {slave: master
+                              for master, link in self.links.items()
+                              for slave in link['SLAVES']}
+
+    def _index_server(self, server):
+        self.server_index[server.id] = server
+        for role in server.roles:
+            self.role_servers[role.id] = server.id
+
+    def _index_servers(self):
+        self.server_index = {}
+        self.role_servers = {}
+        for server in self.bot.servers:
+            self._index_server(server)
+
+    def _unindex_server(self, server):
+        self.server_index.pop(server.id, None)
+        for role in server.roles:
+            self.role_servers.pop(role.id, None)
+        self.role_cache.pop(server.id, None)
 
     def _matching_role(self, inserver, inrole):
         if not isinstance(inserver, discord.Server):
@@ -244,6 +941,12 @@ class HubLinker:
         if inserver is None:
             return None
 
+        mapped = self.role_map.get(inserver.id, {})
+        if inrole.id in mapped:
+            return self._role_from_id(inserver, mapped[inrole.id])
+
+        # Not linked through hublink init yet, fall back to looking for a
+        #   role with the same attributes and remember it if there is one.
         roleattrs = self._explode_role(inrole)
         roleattrs['permissions__value'] = roleattrs['permissions'].value
         del roleattrs['permissions']
@@ -252,15 +955,29 @@ class HubLinker:
 
         log.debug(roleattrs)
         outrole = discord.utils.get(inserver.roles, **roleattrs)
+        if outrole is not None:
+            self._map_role(inserver, inrole, outrole)
         return outrole
 
+    def _map_role(self, slave, master_role, slave_role):
+        self.role_map.setdefault(slave.id, {})[master_role.id] = slave_role.id
+        self.save_role_map()
+
+    def _role_from_id(self, server, role_id):
+        roles = self.role_cache.setdefault(server.id, {})
+        if role_id not in roles:
+            # Missing ids get one refresh in case the role event that should
+            #   have dropped the cache hasn't arrived yet.
+            roles.update((r.id, r) for r in server.roles)
+        return roles.get(role_id)
+
     def _slave_role_check(self, master):
         mid = master.id
         if mid not in self.links:
             return
 
         for sid in self.links[mid]["SLAVES"]:
-            slave = discord.utils.get(self.bot.servers, id=sid)
+            slave = self._server_from_id(sid)
             if slave is None:
                 continue
 
@@ -279,6 +996,16 @@ class HubLinker:
         ret['hoist'] = role.hoist
         return ret
 
+    def _missing_roles(self, master_member, slave_member, pairs):
+        """Master roles of the member whose slave copy they don't have yet"""
+        have = set(r.id for r in slave_member.roles)
+        return [r for r in master_member.roles if self._syncable(r) and
+                (r.id not in pairs or pairs[r.id].id not in have)]
+
+    def _role_fingerprint(self, role):
+        return hash((role.name, role.permissions.value, role.colour.value,
+                     role.hoist))
+
     def _role_equality(self, r1, r2):
         if r1.name != r2.name:
             return False
@@ -288,112 +1015,157 @@ class HubLinker:
             return False
         if r1.hoist != r2.hoist:
             return False
+        return True
+
+    def _same_name(self, r1, r2):
+        return r1.name == r2.name
+
+    def _syncable(self, role):
+        """@everyone and our own role are never copied between servers"""
+        return not role.is_everyone and role.name.lower() != "squid"
 
     def _server_from_id(self, id):
         if isinstance(id, list):
-            return map((lambda s: discord.utils.get(self.bot.servers, id=s)),
-                       id)
-        return discord.utils.get(self.bot.servers, id=id)
-
-    async def _new_role_from_master(self, server, before, after):
-        role_add = []
-        for role in after.roles:
-            if role.name == "@everyone":
-                continue
-            before_role = discord.utils.get(before.roles, id=role.id)
-            if before_role is None:
-                role_add.append(role)
+            return map(self.server_index.get, id)
+        return self.server_index.get(id)
 
-        log.debug('adding roles {}'.format([r.name for r in role_add]))
+    async def _ensure_copy(self, slave, role):
+        """_copy_role, unless another job got there first"""
+        with (await self._queue(slave).create_lock):
+            copy = self._matching_role(slave, role)
+            if copy is None:
+                copy = await self._copy_role(slave, role)
+            return copy
 
-        role_del = []
-        for role in before.roles:
-            if role.name == "@everyone":
-                continue
-            after_role = discord.utils.get(after.roles, id=role.id)
-            if after_role is None:
-                role_del.append(role)
-
-        log.debug('deleting roles {}'.format([r.name for r in role_del]))
-
-        for role in role_add:
-            to_add = map(lambda s: (s, self._matching_role(s, role)),
-                         self.links[server.id]['SLAVES'])
-            for (s, r) in to_add:
-                s = discord.utils.get(self.bot.servers, id=s)
-                if s is None or r is None:
-                    log.debug('ADD slve or role not found, {} {}'.format(
-                        s, r))
-                    continue
-                member = discord.utils.get(s.members, id=after.id)
-                if member is None:
-                    continue
-                log.debug('adding {} to {} on {}'.format(r.name, member.name,
-                                                         member.server.id))
-                await self.bot.add_roles(member, r)
-
-        for role in role_del:
-            to_del = map(lambda s: (s, self._matching_role(s, role)),
-                         self.links[server.id]['SLAVES'])
-            for (s, r) in to_del:
-                s = discord.utils.get(self.bot.servers, id=s)
-                if s is None or r is None:
-                    continue
-                member = discord.utils.get(s.members, id=after.id)
-                if member is None:
-                    continue
-                log.debug('deleting {} to {} on {}'.format(r.name, member.name,
-                                                           member.server.id))
-                discord.compat.create_task(self.bot.remove_roles(member, r))
-
-    async def _status_role_compare(self, master, before, after):
-        if before.status != discord.Status.online and after.status == \
-                discord.Status.online:
-            pass
-        else:
+    def _queue(self, slave):
+        try:
+            return self.queues[slave.id]
+        except KeyError:
+            queue = self.queues[slave.id] = SlaveQueue(self.pace)
+            return queue
+
+    def _queue_member(self, master, slave, member_id, create_missing=False):
+        key = ('member', member_id)
+        self._queue(slave).put(key, self._sync_member, master.id, slave.id,
+                               member_id, create_missing)
+        return key
+
+    def _queue_role(self, master, slave, role_id):
+        self._queue(slave).put(('role', role_id), self._sync_role,
+                               master.id, slave.id, role_id)
+
+    async def _sync_member(self, master, slave, member_id,
+                           create_missing=False):
+        """Gives the slave member the copies of exactly the roles they have
+        on the master, in one request. Slave roles that aren't copies of a
+        master role are left alone.
+        """
+        master = self._server_from_id(master)
+        slave = self._server_from_id(slave)
+        if master is None or slave is None:
             return
-        log.debug('{} came online'.format(after.name))
-        slaves = self._server_from_id(self.links[master.id]['SLAVES'])
-        for slave in slaves:
-            slave_member = discord.utils.get(slave.members, id=after.id)
-            if slave_member is None:
+        master_member = master.get_member(member_id)
+        slave_member = slave.get_member(member_id)
+        if master_member is None or slave_member is None:
+            return
+
+        if create_missing:
+            for master_role in master_member.roles:
+                if self._syncable(master_role) and \
+                        self._matching_role(slave, master_role) is None:
+                    await self._ensure_copy(slave, master_role)
+
+        roles = self._member_roles(master_member, slave_member)
+        if roles is None:
+            return
+        log.debug('setting roles of {0.name} on {1.id}:\n\t{2}'.format(
+            slave_member, slave, [r.name for r in roles]))
+        await self.bot.replace_roles(slave_member, *roles)
+
+    def _member_roles(self, master_member, slave_member):
+        """The slave member's roles with the copies swapped for exactly the
+        ones of their master roles, or None if that's what they have already.
+        """
+        slave = slave_member.server
+        copies = set(self.role_map.get(slave.id, {}).values())
+        roles = [r for r in slave_member.roles
+                 if not r.is_everyone and r.id not in copies]
+        for master_role in master_member.roles:
+            if not self._syncable(master_role):
                 continue
-            for role in after.roles:
-                slave_role = self._matching_role(slave, role)
-                if slave_role and slave_role not in slave_member.roles:
-                    discord.compat.create_task(self.bot.add_roles(
-                        slave_member, slave_role))
+            role = self._matching_role(slave, master_role)
+            if role is not None and role not in roles:
+                roles.append(role)
+
+        current = set(r.id for r in slave_member.roles if not r.is_everyone)
+        if current == set(r.id for r in roles):
+            return None
+        return roles
+
+    async def _sync_role(self, master, slave, role_id):
+        """Creates, edits or deletes the slave's copy of a master role so it
+        matches whatever the master role looks like now.
+        """
+        master = self._server_from_id(master)
+        slave = self._server_from_id(slave)
+        if master is None or slave is None:
+            return
+        role = self._role_from_id(master, role_id)
+        copy_id = self.role_map.get(slave.id, {}).get(role_id)
+        copy = None if copy_id is None else self._role_from_id(slave, copy_id)
+
+        if role is None or not self._syncable(role):
+            if self.role_map.get(slave.id, {}).pop(role_id, None):
+                self.save_role_map()
+            if copy is not None:
+                await self.bot.delete_role(slave, copy)
+        elif copy is None:
+            await self._ensure_copy(slave, role)
+        elif not self._role_equality(copy, role):
+            await self.bot.edit_role(slave, copy, **self._explode_role(role))
+
+    def _end_burst(self, master_id, member_id):
+        """Queues the member for every slave, unless their roles ended up
+        back where the burst of updates started.
+        """
+        roles = self.member_bursts.pop((master_id, member_id))[0]
+        master = self._server_from_id(master_id)
+        member = None if master is None else master.get_member(member_id)
+        if member is None or roles == frozenset(r.id for r in member.roles):
+            return
+        for slave in self._slaves(master):
+            self._queue_member(master, slave, member_id)
+
+    def _slaves(self, master):
+        for sid in self.links[master.id]['SLAVES']:
+            slave = self._server_from_id(sid)
+            if slave is not None:
+                yield slave
 
     async def role_create(self, role):
         server = role.server
+        self.role_cache.pop(server.id, None)
+        self.role_servers[role.id] = server.id
         if not self._exists_and_enabled(server.id):
             return
         if not self._has_manage_role(server.id):
             return
-        sid = server.id
-        log.debug('new role "{}" on master {}'.format(role.name, sid))
-        for slave in self.links[sid]['SLAVES']:
-            slave_server = discord.utils.get(self.bot.servers,
-                                             id=slave)
-            if slave_server is None:
-                continue
-            role_dict = self._explode_role(role)
-            discord.compat.create_task(self.bot.create_role(slave_server,
-                                                            **role_dict))
+        log.debug('new role "{}" on master {}'.format(role.name, server.id))
+        for slave in self._slaves(server):
+            self._queue_role(server, slave, role.id)
 
     async def role_delete(self, role):
         server = role.server
+        self.role_cache.pop(server.id, None)
+        self.role_servers.pop(role.id, None)
         if not self._exists_and_enabled(server.id):
             return
         if not self._has_manage_role(server.id):
             return
-        to_delete = map(lambda s: (s, self._matching_role(s, role)),
-                        self.links[server.id]['SLAVES'])
-        for (s, r) in to_delete:
-            s = self._server_from_id(s)
-            if s is None or r is None:
-                continue
-            discord.compat.create_task(self.bot.delete_role(s, r))
+        for slave in self._slaves(server):
+            # Makes sure copies from before roles were mapped are found
+            if self._matching_role(slave, role) is not None:
+                self._queue_role(server, slave, role.id)
 
     async def role_edit(self, before, after):
         server = self._get_server_from_role(before)
@@ -405,57 +1177,91 @@ class HubLinker:
             return
         log.debug('new edit on master {}:\n\tBefore: {}\n\tAfter: {}'.format(
             server.id, self._explode_role(before), self._explode_role(after)))
-        to_edit = map(lambda s: (s, self._matching_role(s, before)),
-                      self.links[server.id]['SLAVES'])
-        for (s, r) in to_edit:
-            s = self._server_from_id(s)
-            if s is None or r is None:
-                continue
-            discord.compat.create_task(
-                self.bot.edit_role(s, r, **self._explode_role(after)))
+        for slave in self._slaves(server):
+            if self._matching_role(slave, before) is not None:
+                self._queue_role(server, slave, before.id)
 
     async def member_join(self, member):
         slave = member.server
-        master = None
-        for mid in self.links:
-            for sid in self.links[mid]['SLAVES']:
-                if sid == slave.id:
-                    master = mid
-        master = discord.utils.get(self.bot.servers, id=master)
+        master = self._server_from_id(self.slave_masters.get(slave.id))
         if master is None:
             return
         log.debug('{} joined {} with master {}'.format(member.name,
                                                        slave.name,
                                                        master.name))
-        master_member = discord.utils.get(master.members, id=member.id)
-        if master_member is None:
+        if master.get_member(member.id) is None:
             return
-        master_member_roles = master_member.roles
-        for master_role in master_member_roles:
-            if master_role.name.lower() == "@everyone":
-                continue
-            role = self._matching_role(slave, master_role)
-            if role is None:
-                role = await self.bot.create_role(
-                    slave, **self._explode_role(master_role)
-                )
-            await self.bot.add_roles(member, role)
+        self._queue_member(master, slave, member.id, create_missing=True)
 
     async def member_update(self, before, after):
         server = after.server
         if server is None:
             return
+        # Presence updates hand us the same role list on both sides
+        if before.roles is after.roles:
+            return
         if not self._exists_and_enabled(server.id):
             return
         elif not self._has_manage_role(server.id):
             return
 
+        key = (server.id, after.id)
+        burst = self.member_bursts.get(key)
+        if burst is None:
+            roles = frozenset(r.id for r in before.roles)
+            if roles == frozenset(r.id for r in after.roles):
+                return
+            burst = self.member_bursts[key] = [roles, time.monotonic(), None]
+        else:
+            burst[2].cancel()
+
         log.debug('member {} update on master {}'.format(after.name,
                                                          server.id))
+        delay = min(MEMBER_DEBOUNCE,
+                    burst[1] + MEMBER_DEBOUNCE_MAX - time.monotonic())
+        burst[2] = self.bot.loop.call_later(max(delay, 0), self._end_burst,
+                                            server.id, after.id)
+
+    async def drift_checker(self):
+        while self == self.bot.get_cog('HubLinker'):
+            await asyncio.sleep(DRIFT_INTERVAL)
+            for master_id in list(self.links):
+                if not self._exists_and_enabled(master_id) or \
+                        not self._has_manage_role(master_id):
+                    continue
+                master = self._server_from_id(master_id)
+                for slave in list(self._slaves(master)):
+                    # The backfill is already going over every member
+                    if slave.id in self.backfill:
+                        continue
+                    try:
+                        roles, members, strays = await self._check_drift(
+                            master, slave)
+                    except Exception:
+                        log.exception('drift check of {} failed'.format(
+                            slave.id))
+                        continue
+                    self.drift[slave.id] = (time.time(), roles, members,
+                                            strays)
+                    if roles or members or strays:
+                        log.info('{} drifted from {}: {} roles, {} members,'
+                                 ' {} unmapped roles'.format(
+                                     slave.id, master.id, roles, members,
+                                     strays))
+
+    async def ready(self):
+        self._index_servers()
+        self.role_cache = {}
+        self._resume_backfills()
+        self._resume_syncs()
 
-        await self._new_role_from_master(server, before, after)
+    async def server_joined(self, server):
+        self._index_server(server)
+        if self.unfinished:
+            self._resume_syncs()
 
-        await self._status_role_compare(server, before, after)
+    async def server_removed(self, server):
+        self._unindex_server(server)
 
 
 def check_folder():
@@ -464,9 +1270,10 @@ def check_folder():
 
 
 def check_files():
-    f = 'data/hublinker/links.json'
-    if not os.path.exists(f):
-        fileIO(f, 'save', {})
+    for f in ('data/hublinker/links.json', 'data/hublinker/roles.json',
+              'data/hublinker/settings.json', 'data/hublinker/backfill.json'):
+        if not os.path.exists(f):
+            fileIO(f, 'save', {})
 
 
 def setup(bot):
@@ -479,3 +1286,7 @@ def setup(bot):
     bot.add_listener(n.role_edit, 'on_server_role_update')
     bot.add_listener(n.member_join, 'on_member_join')
     bot.add_listener(n.member_update, 'on_member_update')
+    bot.add_listener(n.ready, 'on_ready')
+    bot.add_listener(n.server_joined, 'on_server_join')
+    bot.add_listener(n.server_joined, 'on_server_available')
+    bot.add_listener(n.server_removed, 'on_server_remove')
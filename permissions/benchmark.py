@@ -0,0 +1,343 @@
+"""
+Benchmark for the Permissions cog that runs without connecting to Discord.
+
+Builds synthetic servers, roles, channels and members, fills the cog with
+rules through its own _set_* / _lock_* coroutines and times the calls that
+sit on the path of every command invocation.
+
+Run it from the root of your Red install (so `cogs.utils` can be imported):
+
+    python3 path/to/permissions/benchmark.py --commands 5000 --servers 2000 \\
+        --roles 500
+
+Nothing is written to your data folder, the cog runs in a temp directory.
+"""
+import argparse
+import asyncio
+import gc
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+
+from tabulate import tabulate
+
+# permissions.py does `from __main__ import send_cmd_help, settings`
+
+
+async def send_cmd_help(ctx):
+    pass
+
+
+class settings:
+    owner = "0"
+
+
+class StubRole:
+    def __init__(self, id, name, position, server):
+        self.id = id
+        self.name = name
+        self.position = position
+        self.server = server
+
+    def __repr__(self):
+        return "<StubRole {0.name}>".format(self)
+
+
+class StubChannel:
+    is_private = False
+
+    def __init__(self, id, name, server):
+        self.id = id
+        self.name = name
+        self.server = server
+        self.mention = "#" + name
+
+
+class StubServer:
+    def __init__(self, id):
+        self.id = id
+        self.name = "server-" + id
+        self.roles = []
+        self.channels = []
+        self.members = []
+
+
+class StubMember:
+    def __init__(self, id, server, roles):
+        self.id = id
+        self.name = "member-" + id
+        self.server = server
+        self.roles = roles
+
+
+class StubCommand:
+    def __init__(self, name, cog_name, parent=None):
+        self.name = name
+        self.cog_name = cog_name
+        self.checks = []
+        self.commands = {}
+        if parent is None:
+            self.qualified_name = name
+        else:
+            self.qualified_name = parent.qualified_name + " " + name
+            parent.commands[name] = self
+
+
+class StubMessage:
+    def __init__(self, author, channel):
+        self.author = author
+        self.channel = channel
+        self.server = channel.server
+
+
+class StubContext:
+    def __init__(self, bot, command, message):
+        self.bot = bot
+        self.command = command
+        self.message = message
+
+
+class StubBot:
+    def __init__(self, loop):
+        self.loop = loop
+        self.commands = {}
+        self.cogs = {}
+        self.servers = []
+        self.settings = settings
+        self._channels = {}
+
+    def add_command(self, command):
+        self.commands[command.name] = command
+
+    def remove_command(self, name):
+        return self.commands.pop(name, None)
+
+    def get_channel(self, id):
+        return self._channels.get(id)
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+
+def load_permissions_module():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "permissions.py")
+    spec = importlib.util.spec_from_file_location("permissions", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_bot(loop, args, rng):
+    bot = StubBot(loop)
+    ids = iter(range(10**17, 10**18))
+
+    def next_id():
+        return str(next(ids))
+
+    commands = []
+    parent = None
+    for i in range(args.commands):
+        cog_name = "Cog{}".format(i % args.cogs)
+        if i % 10 == 0:
+            parent = StubCommand("cmd{}".format(i), cog_name)
+            bot.add_command(parent)
+            commands.append(parent)
+        else:
+            # Hang subcommands off the last top level command
+            commands.append(StubCommand("sub{}".format(i), parent.cog_name,
+                                        parent))
+
+    for _ in range(args.servers):
+        server = StubServer(next_id())
+        for pos in range(args.roles):
+            name = "@everyone" if pos == 0 else "role{}".format(pos)
+            server.roles.append(StubRole(next_id(), name, pos, server))
+        for c in range(args.channels):
+            channel = StubChannel(next_id(), "chan{}".format(c), server)
+            server.channels.append(channel)
+            bot._channels[channel.id] = channel
+        for _ in range(args.members):
+            count = rng.randint(1, min(args.roles, args.member_roles))
+            roles = [server.roles[0]] + rng.sample(server.roles[1:],
+                                                   count - 1)
+            server.members.append(StubMember(next_id(), server, roles))
+        bot.servers.append(server)
+
+    return bot, commands
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    if not timings:
+        return ["-"] * 4
+
+    def pick(p):
+        idx = min(len(timings) - 1, int(round(p / 100 * (len(timings) - 1))))
+        return "{:.2f}".format(timings[idx] * 1e6)
+
+    return [len(timings), pick(50), pick(90), pick(99)]
+
+
+def time_sync(func, calls):
+    timings = []
+    for args in calls:
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def time_async(loop, func, calls):
+    timings = []
+    for args in calls:
+        start = time.perf_counter()
+        loop.run_until_complete(func(*args))
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(i, seen) for i in obj)
+    return size
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    permissions = load_permissions_module()
+
+    print("Building {} commands, {} servers, {} roles/server...".format(
+        args.commands, args.servers, args.roles))
+    bot, commands = build_bot(loop, args, rng)
+    cog = permissions.Permissions(bot)
+    bot.cogs["Permissions"] = cog
+
+    def random_context():
+        server = rng.choice(bot.servers)
+        message = StubMessage(rng.choice(server.members),
+                              rng.choice(server.channels))
+        return StubContext(bot, rng.choice(commands), message)
+
+    # Mutations go through the cog's own coroutines
+    set_calls = []
+    for server in bot.servers:
+        for _ in range(args.rules):
+            command = rng.choice(commands)
+            allow = rng.random() < 0.5
+            if rng.random() < 0.5:
+                channel = rng.choice(server.channels)
+                set_calls.append((command, server, channel, None, allow))
+            else:
+                role = rng.choice(server.roles)
+                set_calls.append((command, server, None, role, allow))
+    set_timings = time_async(loop, cog._set_permission, set_calls)
+
+    lock_calls = []
+    for _ in range(args.locks):
+        server = rng.choice(bot.servers)
+        command = rng.choice(commands).qualified_name.replace(" ", ".")
+        lock_calls.append((command, server))
+    lock_timings = time_async(loop, cog._lock_server, lock_calls)
+
+    contexts = [random_context() for _ in range(args.samples)]
+    resolve_calls = [(ctx, ) for ctx in contexts]
+    cog._invalidate_decisions()
+    cold_timings = time_sync(cog.resolve_permission, resolve_calls)
+    warm_timings = time_sync(cog.resolve_permission, resolve_calls)
+    stats = cog.check_stats
+    cog.check_stats = None
+    no_stats_timings = time_sync(cog.resolve_permission, resolve_calls)
+
+    locked_calls = [(ctx.command.qualified_name.replace(" ", "."),
+                     ctx.message.server, ctx.message.channel)
+                    for ctx in contexts]
+    locked_timings = time_sync(cog._is_locked, locked_calls)
+
+    ordered_calls = [(None, ctx.message.author.roles) for ctx in contexts]
+    ordered_timings = time_sync(cog._get_ordered_role_list, ordered_calls)
+
+    gc.collect()
+    perms_size = deep_size(cog.server_perms) + deep_size(cog.global_locks)
+    servers_with_perms = len(cog.server_perms)
+
+    reset_timings = time_async(loop, cog._reset_permission, [
+        (command, server, channel, role)
+        for command, server, channel, role, _ in set_calls[:args.samples]])
+
+    server_reset_calls = [(s, ) for s in bot.servers[:args.samples]]
+    server_reset_timings = time_async(loop, cog._reset, server_reset_calls)
+
+    rows = [
+        ["_set_permission"] + percentiles(set_timings),
+        ["_lock_server"] + percentiles(lock_timings),
+        ["resolve_permission (cold)"] + percentiles(cold_timings),
+        ["resolve_permission (warm)"] + percentiles(warm_timings),
+        ["resolve_permission (no stats)"] + percentiles(no_stats_timings),
+        ["_is_locked"] + percentiles(locked_timings),
+        ["_get_ordered_role_list"] + percentiles(ordered_timings),
+        ["_reset_permission"] + percentiles(reset_timings),
+        ["_reset"] + percentiles(server_reset_timings),
+    ]
+    print(tabulate(rows, headers=["Call", "Count", "p50 (us)", "p90 (us)",
+                                  "p99 (us)"], tablefmt="psql"))
+
+    print("Rules set: {}  Servers with perms: {}  Perms size: {:.1f} KiB"
+          "".format(len(set_calls), servers_with_perms, perms_size / 1024))
+    print("Cache hit rate: {:.1%}  Decided by: {}".format(
+        stats.cache_hits / stats.checks,
+        ", ".join("{} {}/{}".format(rule, stats.allowed[rule],
+                                    stats.denied[rule])
+                  for rule in sorted(set(stats.allowed) | set(stats.denied)))))
+
+    cog._Permissions__unload()
+    loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--commands", type=int, default=5000)
+    parser.add_argument("--cogs", type=int, default=50)
+    parser.add_argument("--servers", type=int, default=2000)
+    parser.add_argument("--roles", type=int, default=500,
+                        help="roles per server")
+    parser.add_argument("--channels", type=int, default=20,
+                        help="channels per server")
+    parser.add_argument("--members", type=int, default=20,
+                        help="members per server")
+    parser.add_argument("--member-roles", type=int, default=10,
+                        help="max roles per member")
+    parser.add_argument("--rules", type=int, default=5,
+                        help="channel/role rules per server")
+    parser.add_argument("--locks", type=int, default=200,
+                        help="server locks spread over all servers")
+    parser.add_argument("--samples", type=int, default=10000,
+                        help="timed calls per measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Let `cogs.utils` resolve from the Red root, then work in a scratch dir
+    #   so the cog's data files go somewhere harmless.
+    sys.path.insert(0, os.getcwd())
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,15 @@ from cogs.utils.dataIO import dataIO
 from cogs.utils import checks
 from cogs.utils.chat_formatting import box
 import os
+import io
+import json
 import logging
-import copy
 import asyncio
 import itertools
+import time
+from collections import Counter, deque
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from tabulate import tabulate
@@ -19,6 +24,25 @@ from __main__ import send_cmd_help, settings
 
 log = logging.getLogger("red.permissions")
 
+# Max compiled decisions kept per (server, command) before that bucket is
+#   dropped and rebuilt on demand.
+DECISION_CACHE_SIZE = 1024
+
+PERMS_DIR = "data/permissions"
+# One file per server, named by server id
+SERVERS_DIR = "data/permissions/servers"
+LOCKS_PATH = "data/permissions/locks.json"
+# Command-major file from before perms were split by server
+LEGACY_PATH = "data/permissions/perms.json"
+# Seconds without edits before perms are written out, and the longest a
+#   steady stream of edits can hold a write back.
+SAVE_DELAY = 2
+SAVE_MAX_DELAY = 10
+# Check timings kept for the percentiles in `p stats`, and the window (in
+#   seconds) the current check rate is measured over.
+STATS_SAMPLES = 10000
+STATS_WINDOW = 60
+
 
 class PermissionsError(CommandNotFound):
     """
@@ -68,14 +92,10 @@ class Check:
 
         has_perm = perm_cog.resolve_permission(ctx)
 
-        if has_perm:
-            log.debug("user {} allowed to execute {}"
-                      " chid {}".format(ctx.message.author.name,
-                                        ctx.command.qualified_name,
-                                        ctx.message.channel.id))
-        else:
-            log.debug("user {} not allowed to execute {}"
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("user {} {}allowed to execute {}"
                       " chid {}".format(ctx.message.author.name,
+                                        "" if has_perm else "not ",
                                         ctx.command.qualified_name,
                                         ctx.message.channel.id))
 
@@ -88,6 +108,61 @@ class Check:
         return settings.owner
 
 
+class CheckStats:
+    """
+    Counters behind `p stats`. Decisions are keyed by the rule that made
+        them, see Permissions._compile_permission.
+    """
+
+    def __init__(self):
+        # perf_counter is what resolve_permission times checks with
+        self.started = time.perf_counter()
+        self.checks = 0
+        self.cache_hits = 0
+        self.allowed = Counter()
+        self.denied = Counter()
+        self.timings = deque(maxlen=STATS_SAMPLES)
+        # (second, checks) for the last STATS_WINDOW finished seconds, the
+        #   current second is counted separately.
+        self.buckets = deque(maxlen=STATS_WINDOW)
+        self._second = int(self.started)
+        self._second_checks = 0
+
+    def record(self, decision, cache_hit, start, end):
+        self.checks += 1
+        if cache_hit:
+            self.cache_hits += 1
+        if decision[0]:
+            self.allowed[decision[1]] += 1
+        else:
+            self.denied[decision[1]] += 1
+        self.timings.append(end - start)
+
+        second = int(end)
+        if second != self._second:
+            self.buckets.append((self._second, self._second_checks))
+            self._second = second
+            self._second_checks = 0
+        self._second_checks += 1
+
+    def percentile(self, p):
+        if not self.timings:
+            return 0.0
+        timings = sorted(self.timings)
+        return timings[min(len(timings) - 1,
+                           int(round(p / 100 * (len(timings) - 1))))]
+
+    def rate(self):
+        """Checks per second over the last STATS_WINDOW seconds"""
+        now = time.perf_counter()
+        window = min(STATS_WINDOW, max(now - self.started, 1))
+        recent = sum(count for second, count in self.buckets
+                     if second > now - window)
+        if self._second > now - window:
+            recent += self._second_checks
+        return recent / window
+
+
 class Permissions:
     """
     The VERY important thing to note about this cog is that every command will
@@ -98,47 +173,215 @@ class Permissions:
     def __init__(self, bot):
         self.bot = bot
 
-        # All the saved permission levels with role ID's
-        self.perms_we_want = self._load_perms()
+        # All the saved permission levels with role ID's, split by server and
+        #   only loaded for servers we're actually in. A server's perms are
+        #   never edited in place: writers build a copy and swap it in (see
+        #   _copy_shard), so checks read them without ever taking perm_lock.
+        #   {server id: {"COMMANDS": {command: {"CHANNELS": {}, "ROLES": {}}},
+        #                "LOCKS": {"SERVER": {command: True},
+        #                          "CHANNELS": {chan id: {command: True}}}}}
+        self.server_perms = {}
+        # Locks not tied to a server: locked commands and locked cog names
+        locks = self._load_perms()
+        self.global_locks = frozenset(locks.get("GLOBAL", []))
+        self.cog_locks = frozenset(locks.get("COGS", []))
+
+        # Dotted name -> Command (aliases included) and Command -> dotted
+        #   name, rebuilt on demand after the command tree changes.
+        self.command_index = None
+        self.command_dots = None
+        # Dotted command -> cog name, filled in as checks are installed so
+        #   cog locks never need to resolve the command.
+        self.command_cogs = {}
+
+        # Server ids that have a file in SERVERS_DIR
+        self._shard_ids = self._list_shards()
         self.perm_lock = asyncio.Lock()
 
-        self.check_adder = bot.loop.create_task(self.add_checks_to_all())
+        # Compiled decisions keyed as:
+        #   {server id: {command: {(channel id, role id set): (bool, rule)}}}
+        self.decision_cache = {}
+
+        # Role hierarchy per server, {server id: {role id: position}}. Built
+        #   on first use and kept current by the role events.
+        self.role_positions = {}
+
+        # Check metrics for `p stats`, None while they're switched off
+        self.check_stats = CheckStats()
+
+        # Write-behind state for _save_perms. A single worker keeps writes
+        #   ordered.
+        self._dirty = set()
+        self._dirty_since = None
+        self._save_handle = None
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._unloaded = False
+
+        self._load_servers()
+
+        # Checks only need (re)installing when commands get added, so we hook
+        #   add_command instead of polling every command forever.
+        self._bot_add_command = bot.add_command
+        bot.add_command = self._add_command_hook
+        self._bot_remove_command = bot.remove_command
+        bot.remove_command = self._remove_command_hook
+        self.add_checks_to_all()
 
     def __unload(self):
-        if self.check_adder:
-            self.check_adder.cancel()
+        if self.bot.add_command == self._add_command_hook:
+            self.bot.add_command = self._bot_add_command
+        if self.bot.remove_command == self._remove_command_hook:
+            self.bot.remove_command = self._bot_remove_command
+
+        self._unloaded = True
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+        # Let any in flight write land before the final one
+        self._save_executor.shutdown(wait=True)
+        if self._dirty:
+            self._write_perms(self._collect_writes())
+
+        # Every command, subcommands included: checks outlive the perms that
+        #   got them installed (p reset, leaving a server).
+        self.command_index = None
+        for cmd in self._get_command_index()[1]:
+            if any(isinstance(c, Check) for c in cmd.checks):
+                cmd.checks = [c for c in cmd.checks
+                              if not isinstance(c, Check)]
+
+    def _add_command_hook(self, command):
+        self._bot_add_command(command)
+        # Only the new command needs indexing and checking, a full rebuild
+        #   per command makes loading a cog quadratic.
+        index, dots = self._get_command_index()
+        new_index = {}
+        new_dots = {}
+        self._walk_commands({name: command for name in
+                             [command.name] + list(command.aliases)},
+                            new_index, new_dots)
+        index.update(new_index)
+        dots.update(new_dots)
+
+        installed = 0
+        for cmd_obj, cmd_dot in new_dots.items():
+            if cmd_obj.cog_name in self.cog_locks or \
+                    self._has_perms(cmd_dot):
+                if self._install_check(cmd_dot):
+                    installed += 1
+        if installed:
+            log.info("installed {} permission checks".format(installed))
+
+    async def _apply_rules(self, server, ops):
+        """
+        Applies parsed rules under a single lock and with a single save.
+        """
+        with (await self.perm_lock):
+            shard = self._copy_shard(server)
+            for kind, command, target_id, allow in ops:
+                if kind == "SERVER_LOCK":
+                    shard["LOCKS"]["SERVER"][command] = True
+                    self._install_check(command)
+                elif kind == "CHANNEL_LOCK":
+                    chan_locks = self._copy_chan_locks(shard, target_id)
+                    chan_locks[command] = True
+                    self._install_check(command)
+                else:
+                    self._put_rule(shard, command, kind, target_id, allow)
+            self._publish_shard(server, shard)
+            self._invalidate_decisions(server)
 
-        for cmd_dot in self.perms_we_want:
-            try:
-                cmd = self._get_command(cmd_dot)
-            except BadCommand:
-                # Just means the command couldn't be found which is okay
-                #   because we're unloading anyways.
-                pass
+        self._save_perms(server)
+
+    def _collect_writes(self):
+        """
+        Gathers everything marked dirty into (path, data) pairs for
+            _write_perms, data being None when the file should go away.
+            Published perms are never edited so the worker can serialize
+            them itself.
+        """
+        writes = []
+        for sid in self._dirty:
+            if sid is None:
+                locks = {"GLOBAL": sorted(self.global_locks),
+                         "COGS": sorted(self.cog_locks)}
+                writes.append((LOCKS_PATH, locks))
+                continue
+
+            shard = self.server_perms.get(sid)
+            if shard is None or self._shard_empty(shard):
+                self._shard_ids.discard(sid)
+                writes.append((self._shard_path(sid), None))
             else:
-                keepers = [c for c in cmd.checks if not isinstance(c, Check)]
-                cmd.checks = keepers
-
-    async def _check_perm_entry(self, command, server):
-        await self.perm_lock.acquire()
-        if command not in self.perms_we_want:
-            self.perms_we_want[command] = {"LOCKS": {"GLOBAL": False,
-                                                     "SERVERS": {},
-                                                     "CHANNELS": {}}}
-
-        if server.id not in self.perms_we_want[command]:
-            self.perms_we_want[command][server.id] = {"CHANNELS": {},
-                                                      "ROLES": {}}
-
-        if "LOCKS" not in self.perms_we_want[command]:
-            self.perms_we_want[command]["LOCKS"] = {"GLOBAL": False,
-                                                    "COGS": [],
-                                                    "SERVERS": {},
-                                                    "CHANNELS": {}}
-
-        if "COGS" not in self.perms_we_want[command]["LOCKS"]:
-            self.perms_we_want[command]["LOCKS"]["COGS"] = []
-        self.perm_lock.release()
+                self._shard_ids.add(sid)
+                writes.append((self._shard_path(sid), shard))
+
+        self._dirty.clear()
+        self._dirty_since = None
+        return writes
+
+    def _command_cog(self, command):
+        try:
+            return self.command_cogs[command]
+        except KeyError:
+            pass
+
+        try:
+            cog_name = self._get_command(command).cog_name
+        except BadCommand:
+            return None
+        self.command_cogs[command] = cog_name
+        return cog_name
+
+    def _copy_chan_locks(self, shard, chanid):
+        """
+        Copies the locks of one channel inside a copied shard so they can be
+            edited.
+        """
+        chan_locks = dict(shard["LOCKS"]["CHANNELS"].get(chanid, {}))
+        shard["LOCKS"]["CHANNELS"][chanid] = chan_locks
+        return chan_locks
+
+    def _copy_command(self, shard, command):
+        """
+        Copies the entry of one command inside a copied shard so it can be
+            edited, creating it if needed.
+        """
+        old = shard["COMMANDS"].get(command)
+        if old is None:
+            new = {"CHANNELS": {}, "ROLES": {}}
+            self._install_check(command)
+        else:
+            new = {"CHANNELS": dict(old["CHANNELS"]),
+                   "ROLES": dict(old["ROLES"])}
+        shard["COMMANDS"][command] = new
+        return new
+
+    def _copy_shard(self, server):
+        """
+        Returns a copy of a server's perms that is safe to edit. Only the top
+            level is copied, anything nested has to go through
+            _copy_command/_copy_chan_locks before it's changed. The result
+            replaces the live perms with _publish_shard.
+        """
+        old = self._get_shard(server)
+        if old is None:
+            return {"COMMANDS": {}, "LOCKS": {"SERVER": {}, "CHANNELS": {}}}
+        return {"COMMANDS": dict(old["COMMANDS"]),
+                "LOCKS": {"SERVER": dict(old["LOCKS"]["SERVER"]),
+                          "CHANNELS": dict(old["LOCKS"]["CHANNELS"])}}
+
+    def _dotted(self, command):
+        """
+        Dot notation name of a Command object.
+        """
+        try:
+            return self._get_command_index()[1][command]
+        except KeyError:
+            return command.qualified_name.replace(' ', '.')
+
+    def _dump(self, data):
+        return json.dumps(data, indent=4, sort_keys=True,
+                          separators=(',', ' : '))
 
     def _error_raise(exc):
         def deco(func):
@@ -170,19 +413,122 @@ class Permissions:
                                         " playlist.add instead of \"playlist"
                                         " add\")")
 
+    def _export_rules(self, server):
+        """
+        Turns a server's perms into the rule file format read by p import.
+        """
+        rules = []
+        shard = self._get_shard(server)
+        if shard is None:
+            return {"rules": rules}
+
+        for command, per_server in sorted(shard["COMMANDS"].items()):
+            for chanid, status in sorted(per_server["CHANNELS"].items()):
+                chan = self.bot.get_channel(chanid)
+                if chan:
+                    rules.append({"command": command, "channel": chan.name,
+                                  "allow": self._is_allow(status)})
+            for roleid, status in sorted(per_server["ROLES"].items()):
+                role = discord.utils.get(server.roles, id=roleid)
+                if role:
+                    rules.append({"command": command, "role": role.name,
+                                  "allow": self._is_allow(status)})
+
+        for command in sorted(shard["LOCKS"]["SERVER"]):
+            rules.append({"command": command, "lock": "server"})
+        for chanid, chan_locks in sorted(shard["LOCKS"]["CHANNELS"].items()):
+            chan = self.bot.get_channel(chanid)
+            if chan:
+                for command in sorted(chan_locks):
+                    rules.append({"command": command, "lock": "channel",
+                                  "channel": chan.name})
+
+        return {"rules": rules}
+
+    async def _fetch_attachment(self, url):
+        with aiohttp.ClientSession() as session:
+            with aiohttp.Timeout(10):
+                async with session.get(url) as r:
+                    return await r.text()
+
+    def _flush_perms(self):
+        self._save_handle = None
+        if not self._dirty:
+            return
+        dirty = set(self._dirty)
+        writes = self._collect_writes()
+        future = self.bot.loop.run_in_executor(self._save_executor,
+                                               self._write_perms, writes)
+        future.add_done_callback(
+            lambda future: self._flush_done(future, dirty))
+
+    def _flush_done(self, future, dirty):
+        """
+        Puts whatever a failed write was carrying back on the dirty list so
+            it's tried again, instead of being lost until the next edit.
+        """
+        if future.cancelled() or future.exception() is None:
+            return
+        log.error("could not save perms, retrying in {}s".format(
+            SAVE_MAX_DELAY), exc_info=future.exception())
+        self._dirty |= dirty
+        if self._unloaded:
+            # Unload already did its final write, nothing else will retry
+            self._write_perms(self._collect_writes())
+            return
+        if self._dirty_since is None:
+            self._dirty_since = time.monotonic()
+        if self._save_handle is None:
+            self._save_handle = self.bot.loop.call_later(SAVE_MAX_DELAY,
+                                                         self._flush_perms)
+
     @_error_raise(BadCommand)
     def _get_command(self, cmd_string):
+        try:
+            return self._get_command_index()[0][cmd_string]
+        except KeyError:
+            pass
+
+        # Groups can grow subcommands without going through add_command, so
+        #   fall back to walking the tree and rebuild the index if that finds
+        #   something it didn't have.
         cmd = cmd_string.split('.')
         ret = self.bot.commands[cmd.pop(0)]
         while len(cmd) > 0:
             ret = ret.commands[cmd.pop(0)]
+        self.command_index = None
         return ret
 
+    def _get_command_index(self):
+        if self.command_index is None:
+            index = {}
+            dots = {}
+            self._walk_commands(self.bot.commands, index, dots)
+            self.command_index = index
+            self.command_dots = dots
+        return self.command_index, self.command_dots
+
+    def _walk_commands(self, cmds, index, dots):
+        """
+        Adds cmds and all their subcommands to the command index.
+        """
+        to_walk = [("", cmds)]
+        while to_walk:
+            prefix, cmds = to_walk.pop()
+            for name, cmd_obj in cmds.items():
+                index[prefix + name] = cmd_obj
+                dots[cmd_obj] = cmd_obj.qualified_name.replace(' ', '.')
+                subcommands = getattr(cmd_obj, "commands", None)
+                if subcommands:
+                    to_walk.append((prefix + name + ".", subcommands))
+
     async def _get_info(self, server, command):
-        await self.perm_lock.acquire()
-        command = command.qualified_name.replace(' ', '.')
+        command = self._dotted(command)
 
-        per_server = self.perms_we_want[command][server.id]
+        per_server = {"CHANNELS": {}, "ROLES": {}}
+        shard = self._get_shard(server)
+        if shard is not None:
+            per_server = shard["COMMANDS"].get(command, per_server)
         ret = {"CHANNELS": [], "ROLES": []}
         for chanid, status in per_server["CHANNELS"].items():
             chan = self.bot.get_channel(chanid)
@@ -192,7 +538,7 @@ class Permissions:
                 ret["CHANNELS"].append((chan.name, allow_str))
 
         for roleid, status in per_server["ROLES"].items():
-            role = self._get_role_from_id(server, roleid)
+            role = discord.utils.get(server.roles, id=roleid)
             if role:
                 allowed = self._is_allow(status)
                 allow_str = "Allowed" if allowed else "Denied"
@@ -203,7 +549,6 @@ class Permissions:
 
         role_sort = sorted(ret["ROLES"], key=lambda r: r[0])
         ret["ROLES"] = role_sort
-        self.perm_lock.release()
 
         return ret
 
@@ -220,12 +565,15 @@ class Permissions:
         else:
             server = roles[0].server
 
-        ordered_roles = sorted(roles, key=lambda r: r.position)
+        positions = self._get_role_positions(server)
+        ordered_roles = sorted(
+            roles, key=lambda r: positions.get(r.id, r.position))
 
-        log.debug("Ordered roles for sid {}:\n\t{}".format(server.id,
-                                                           ordered_roles))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Ordered roles for sid {}:\n\t{}".format(
+                server.id, ordered_roles))
 
-        return sorted(roles, key=lambda r: r.position)
+        return ordered_roles
 
     def _get_role(self, roles, role_string):
         if role_string.lower() == "everyone":
@@ -254,23 +602,86 @@ class Permissions:
             raise RoleNotFound(server, roleid)
         return role
 
+    def _get_role_positions(self, server):
+        try:
+            return self.role_positions[server.id]
+        except KeyError:
+            positions = {r.id: r.position for r in server.roles}
+            self.role_positions[server.id] = positions
+            return positions
+
+    def _get_shard(self, server):
+        """
+        Returns the perms of a server, loading them from disk the first time
+            they're needed. None if the server has none. Don't edit what you
+            get back, see _copy_shard.
+        """
+        sid = getattr(server, "id", server)
+        try:
+            return self.server_perms[sid]
+        except KeyError:
+            pass
+
+        if sid in self._shard_ids:
+            shard = dataIO.load_json(self._shard_path(sid))
+        else:
+            return None
+
+        self.server_perms[sid] = shard
+        for command in self._shard_commands(shard):
+            self._install_check(command)
+        return shard
+
     def _get_server_from_id(self, serverid):
         return discord.utils.get(self.bot.servers, id=serverid)
 
     def _has_higher_role(self, member, role):
-        server = member.server
-        roles = self._get_ordered_role_list(server=server)
+        positions = self._get_role_positions(member.server)
         try:
-            role_index = roles.index(role)
-        except ValueError:
-            # Role isn't in the ordered role list
+            role_position = positions[role.id]
+        except KeyError:
+            # Role isn't in the server's hierarchy
             return False
 
-        higher_roles = roles[role_index + 1:]
+        return self._top_role_position(positions, member.roles) > \
+            role_position
 
-        if any([r in higher_roles for r in member.roles]):
-            return True
-        return False
+    def _install_check(self, cmd_dot):
+        """
+        Returns True if a Check had to be added to the command.
+        """
+        try:
+            cmd_obj = self._get_command(cmd_dot)
+        except BadCommand:
+            # Command is no longer loaded/found
+            return False
+
+        self.command_cogs[cmd_dot] = cmd_obj.cog_name
+
+        check_obj = discord.utils.find(
+            lambda c: type(c).__name__ == "Check", cmd_obj.checks)
+        if check_obj is not None:
+            return False
+
+        log.debug("Check object not found in {}, adding".format(cmd_dot))
+        cmd_obj.checks.append(Check(cmd_dot))
+        return True
+
+    def _invalidate_decisions(self, server=None, command=None):
+        """
+        Drops compiled decisions. Limited to a server and/or dotted command
+            when they are given, otherwise everything goes.
+        """
+        sid = getattr(server, "id", server)
+        if sid is not None and command is not None:
+            self.decision_cache.get(sid, {}).pop(command, None)
+        elif sid is not None:
+            self.decision_cache.pop(sid, None)
+        elif command is not None:
+            for per_server in self.decision_cache.values():
+                per_server.pop(command, None)
+        else:
+            self.decision_cache.clear()
 
     def _is_allow(self, permission):
         if permission.startswith("+"):
@@ -278,96 +689,286 @@ class Permissions:
         return False
 
     def _is_locked(self, command, server, channel):
-        locks = self.perms_we_want[command].get("LOCKS", None)
+        return self._lock_type(command, server, channel) is not None
 
-        if locks is None:
-            return False
-
-        global_lock = locks["GLOBAL"]
-        server_lock = locks["SERVERS"].get(server.id, False)
-        channel_lock = locks["CHANNELS"].get(channel.id, False)
-
-        cog_name = self._get_command(command).cog_name
-        cog_lock = cog_name in locks.get("COGS", set())
-
-        return global_lock or cog_lock or server_lock or channel_lock
+    def _list_shards(self):
+        return set(f[:-len(".json")] for f in os.listdir(SERVERS_DIR)
+                   if f.endswith(".json"))
 
     def _load_perms(self):
+        if not os.path.exists(SERVERS_DIR):
+            os.makedirs(SERVERS_DIR)
         try:
-            ret = dataIO.load_json("data/permissions/perms.json")
+            ret = dataIO.load_json(LOCKS_PATH)
         except:
             ret = {}
-            if not os.path.exists("data/permissions"):
-                os.mkdir("data/permissions")
-            dataIO.save_json("data/permissions/perms.json", ret)
+            dataIO.save_json(LOCKS_PATH, ret)
         return ret
 
-    async def _lock_channel(self, command, channel, lock=True):
-        await self._check_perm_entry(command, channel.server)
+    def _load_servers(self):
+        """
+        Loads the perms of every server we're currently in.
+        """
+        self._migrate_legacy()
+        for server in self.bot.servers:
+            self._get_shard(server)
+
+    def _lock_type(self, command, server, channel):
+        """Returns which lock ("global", "cog", "server" or "channel") keeps
+            command from running in channel, if any
+        """
+        if command in self.global_locks:
+            return "global"
+        if self.cog_locks and self._command_cog(command) in self.cog_locks:
+            return "cog"
+
+        shard = self._get_shard(server)
+        if shard is None:
+            return None
+
+        locks = shard["LOCKS"]
+        if command in locks["SERVER"]:
+            return "server"
+        if command in locks["CHANNELS"].get(channel.id, ()):
+            return "channel"
+        return None
 
+    async def _lock_channel(self, command, channel, lock=True):
         with (await self.perm_lock):
-            self.perms_we_want[command]["LOCKS"]["CHANNELS"][channel.id] = lock
+            shard = self._copy_shard(channel.server)
+            chan_locks = self._copy_chan_locks(shard, channel.id)
+            if lock:
+                chan_locks[command] = True
+                self._install_check(command)
+            else:
+                chan_locks.pop(command, None)
+                if not chan_locks:
+                    del shard["LOCKS"]["CHANNELS"][channel.id]
+            self._publish_shard(channel.server, shard)
+            self._invalidate_decisions(channel.server, command)
 
-        self._save_perms()
+        self._save_perms(channel.server)
 
     async def _lock_cog(self, server, cogname, lock=True):
-        cmds = list(filter(lambda c: c.cog_name == cogname,
-                           self.bot.commands.values()))
-        for cmd_name in cmds:
-            command = cmd_name.qualified_name.replace(" ", ".")
-            await self._check_perm_entry(command, server)
-            await self.perm_lock.acquire()
+        # Subcommands too, cog locks apply to them as well
+        cmds = [c for c in self._get_command_index()[1]
+                if c.cog_name == cogname]
+        with (await self.perm_lock):
             if lock:
-                if cogname not in \
-                        self.perms_we_want[command]["LOCKS"]["COGS"]:
-                    self.perms_we_want[command]["LOCKS"]["COGS"].append(
-                        cogname)
+                self.cog_locks = self.cog_locks | {cogname}
             else:
-                try:
-                    self.perms_we_want[command]["LOCKS"]["COGS"].remove(
-                        cogname)
-                except Exception:
-                    # Cog wasn't locked
-                    pass
-            self.perm_lock.release()
+                self.cog_locks = self.cog_locks - {cogname}
+
+            for cmd_obj in cmds:
+                command = self._dotted(cmd_obj)
+                if lock:
+                    self._install_check(command)
+                self._invalidate_decisions(command=command)
 
         self._save_perms()
 
     async def _lock_global(self, command, server, lock=True):
-        await self._check_perm_entry(command, server)
-
         with (await self.perm_lock):
-            self.perms_we_want[command]["LOCKS"]["GLOBAL"] = lock
+            if lock:
+                self.global_locks = self.global_locks | {command}
+                self._install_check(command)
+            else:
+                self.global_locks = self.global_locks - {command}
+            self._invalidate_decisions(command=command)
 
         self._save_perms()
 
     async def _lock_server(self, command, server, lock=True):
-        await self._check_perm_entry(command, server)
-
         with (await self.perm_lock):
-            self.perms_we_want[command]["LOCKS"]["SERVERS"][server.id] = lock
+            shard = self._copy_shard(server)
+            if lock:
+                shard["LOCKS"]["SERVER"][command] = True
+                self._install_check(command)
+            else:
+                shard["LOCKS"]["SERVER"].pop(command, None)
+            self._publish_shard(server, shard)
+            self._invalidate_decisions(server, command)
 
-        self._save_perms()
+        self._save_perms(server)
 
-    async def _reset(self, server):
-        await self.perm_lock.acquire()
-        for cmd in self.perms_we_want:
+    def _migrate_legacy(self):
+        """
+        Splits a command-major perms.json into per server files. Waits until
+            we can see our servers since channel locks have to be matched to
+            the server they belong to.
+        """
+        if not os.path.exists(LEGACY_PATH) or not self.bot.servers:
+            return
+
+        legacy = dataIO.load_json(LEGACY_PATH)
+        shards = {}
+        global_locks = set(self.global_locks)
+        cog_locks = set(self.cog_locks)
+
+        def shard_for(sid):
+            if sid not in shards:
+                shards[sid] = self._copy_shard(sid)
+                self._dirty.add(sid)
+            return shards[sid]
+
+        for command, entry in legacy.items():
+            for key, value in entry.items():
+                if key != "LOCKS":
+                    shard_for(key)["COMMANDS"][command] = value
+                    continue
+
+                if value.get("GLOBAL"):
+                    global_locks.add(command)
+                    self._dirty.add(None)
+                if value.get("COGS"):
+                    cog_locks.update(value["COGS"])
+                    self._dirty.add(None)
+
+                for sid, locked in value.get("SERVERS", {}).items():
+                    if locked:
+                        shard_for(sid)["LOCKS"]["SERVER"][command] = True
+
+                for chanid, locked in value.get("CHANNELS", {}).items():
+                    if not locked:
+                        continue
+                    channel = self.bot.get_channel(chanid)
+                    if channel is None:
+                        log.warning("dropping {} lock on unknown channel"
+                                    " {}".format(command, chanid))
+                        continue
+                    shard = shard_for(channel.server.id)
+                    self._copy_chan_locks(shard, chanid)[command] = True
+
+        self.global_locks = frozenset(global_locks)
+        self.cog_locks = frozenset(cog_locks)
+        for sid, shard in shards.items():
+            self._publish_shard(sid, shard)
+        self.add_checks_to_all()
+        # Write the new files before letting go of the old one
+        self._write_perms(self._collect_writes())
+        os.replace(LEGACY_PATH, LEGACY_PATH + ".migrated")
+        log.info("migrated {} commands out of {}".format(len(legacy),
+                                                         LEGACY_PATH))
+
+    def _parse_rule(self, server, rule):
+        try:
+            name = rule["command"]
+        except (KeyError, TypeError):
+            raise ValueError('missing "command"')
+        commands = self._rule_commands(name)
+
+        channel = role = None
+        if "channel" in rule:
+            channel = self._rule_channel(server, rule["channel"])
+        if "role" in rule:
+            role = self._rule_role(server, rule["role"])
+
+        lock = rule.get("lock")
+        if lock == "server":
+            return [("SERVER_LOCK", c, None, True) for c in commands]
+        elif lock == "channel":
+            if channel is None:
+                raise ValueError('channel locks need a "channel"')
+            return [("CHANNEL_LOCK", c, channel.id, True) for c in commands]
+        elif lock is not None:
+            raise ValueError('"lock" must be "server" or "channel"')
+
+        allow = rule.get("allow")
+        if not isinstance(allow, bool):
+            raise ValueError('"allow" must be true or false')
+        if (channel is None) == (role is None):
+            raise ValueError('needs exactly one of "channel" or "role"')
+
+        if channel is not None:
+            return [("CHANNELS", c, channel.id, allow) for c in commands]
+        return [("ROLES", c, role.id, allow) for c in commands]
+
+    def _parse_rules(self, server, data):
+        """
+        Validates a rule file against a server. Returns the operations to
+            apply and a list of problems, nothing should be applied unless
+            the list is empty.
+        """
+        rules = data.get("rules") if isinstance(data, dict) else data
+        if not isinstance(rules, list):
+            return [], ['The file needs a "rules" list.']
+
+        ops = []
+        errors = []
+        for i, rule in enumerate(rules, 1):
             try:
-                del self.perms_we_want[cmd][server.id]
-            except KeyError:
-                pass
+                ops.extend(self._parse_rule(server, rule))
+            except ValueError as e:
+                errors.append("Rule {}: {}".format(i, e))
+        return ops, errors
 
-            for chan in server.channels:
-                try:
-                    del self.perms_we_want[cmd]["LOCKS"]["CHANNELS"][chan.id]
-                except KeyError:
-                    pass
-        self.perm_lock.release()
-        self._save_perms()
+    def _has_perms(self, cmd_dot):
+        """
+        Whether any perms or locks name the dotted command, without
+            building _perm_commands.
+        """
+        if cmd_dot in self.global_locks:
+            return True
+        for shard in self.server_perms.values():
+            locks = shard["LOCKS"]
+            if cmd_dot in shard["COMMANDS"] or cmd_dot in locks["SERVER"]:
+                return True
+            if any(cmd_dot in chan_locks
+                   for chan_locks in locks["CHANNELS"].values()):
+                return True
+        return False
+
+    def _perm_commands(self):
+        """
+        Every dotted command that has perms or locks we know about.
+        """
+        ret = set(self.global_locks)
+        for shard in self.server_perms.values():
+            ret.update(self._shard_commands(shard))
+        if self.cog_locks:
+            ret.update(dotted
+                       for c, dotted in self._get_command_index()[1].items()
+                       if c.cog_name in self.cog_locks)
+        return ret
+
+    def _prune_command(self, shard, command):
+        per_server = shard["COMMANDS"][command]
+        if not per_server["CHANNELS"] and not per_server["ROLES"]:
+            del shard["COMMANDS"][command]
+
+    def _put_rule(self, shard, cmd_dot_name, kind, target_id, allow):
+        """
+        kind is either "CHANNELS" or "ROLES", shard has to be a copy from
+            _copy_shard.
+        """
+        if allow:
+            allow = "+"
+        else:
+            allow = "-"
+        self._copy_command(shard, cmd_dot_name)[kind][target_id] = \
+            "{}{}".format(allow, cmd_dot_name)
+
+    def _publish_shard(self, server, shard):
+        """
+        Swaps a copy made with _copy_shard in as the live perms of a server.
+        """
+        self.server_perms[getattr(server, "id", server)] = shard
+
+    def _remove_command_hook(self, name):
+        self.command_index = None
+        return self._bot_remove_command(name)
+
+    async def _reset(self, server):
+        with (await self.perm_lock):
+            self.server_perms.pop(server.id, None)
+            # Keeps the stale file from being loaded before it's removed
+            self._shard_ids.discard(server.id)
+            self._invalidate_decisions(server)
+        self._save_perms(server)
 
     async def _reset_channel(self, command, server, channel):
         try:
-            command = command.qualified_name.replace(' ', '.')
+            command = self._dotted(command)
         except AttributeError:
             # If we pass a cog name in as command
             cmds = list(filter(lambda c: c.cog_name == command,
@@ -375,21 +976,20 @@ class Permissions:
             for cmd in cmds:
                 await self._reset_channel(cmd, server, channel)
             return
-        if command not in self.perms_we_want:
-            return
 
-        await self.perm_lock.acquire()
-        cmd_perms = self.perms_we_want[command]
-        if server.id not in cmd_perms:
-            return
+        with (await self.perm_lock):
+            current = self._get_shard(server)
+            if current is None or command not in current["COMMANDS"]:
+                return
 
-        try:
-            del self.perms_we_want[command][server.id]["CHANNELS"][channel.id]
-        except KeyError:
-            pass
+            shard = self._copy_shard(server)
+            self._copy_command(shard, command)["CHANNELS"].pop(channel.id,
+                                                               None)
+            self._prune_command(shard, command)
+            self._publish_shard(server, shard)
+            self._invalidate_decisions(server, command)
 
-        self.perm_lock.release()
-        self._save_perms()
+        self._save_perms(server)
 
     async def _reset_permission(self, command, server, channel=None,
                                 role=None):
@@ -400,100 +1000,168 @@ class Permissions:
 
     async def _reset_role(self, command, server, role):
         try:
-            command = command.qualified_name.replace(' ', '.')
+            command = self._dotted(command)
         except AttributeError:
             # If we pass a cog name in as command
             cmds = list(filter(lambda c: c.cog_name == command,
                                self.bot.commands.values()))
             for cmd in cmds:
-                self._reset_role(cmd, server, role)
-            return
-
-        await self.perm_lock.acquire()
-        if command not in self.perms_we_want:
+                await self._reset_role(cmd, server, role)
             return
 
-        cmd_perms = self.perms_we_want[command]
-        if server.id not in cmd_perms:
-            return
+        with (await self.perm_lock):
+            current = self._get_shard(server)
+            if current is None or command not in current["COMMANDS"]:
+                return
 
-        try:
-            del self.perms_we_want[command][server.id]["ROLES"][role.id]
-        except KeyError:
-            pass
-        self.perm_lock.release()
+            shard = self._copy_shard(server)
+            self._copy_command(shard, command)["ROLES"].pop(role.id, None)
+            self._prune_command(shard, command)
+            self._publish_shard(server, shard)
+            self._invalidate_decisions(server, command)
 
-        self._save_perms()
+        self._save_perms(server)
 
     def resolve_permission(self, ctx):
-        command = ctx.command.qualified_name.replace(' ', '.')
+        stats = self.check_stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        command = self._dotted(ctx.command)
         server = ctx.message.server
         channel = ctx.message.channel
-        roles = reversed(self._get_ordered_role_list(
-            roles=ctx.message.author.roles))
+        author_roles = ctx.message.author.roles
+        key = (channel.id, frozenset(r.id for r in author_roles))
 
         try:
-            per_command = self.perms_we_want[command]
+            decision = self.decision_cache[server.id][command][key]
+            cache_hit = True
         except KeyError:
-            log.debug("{} not in perms_we_want".format(command))
-            return True
-
+            decision = self._compile_permission(command, server, channel,
+                                                author_roles)
+            cache_hit = False
+
+            per_server = self.decision_cache.setdefault(server.id, {})
+            per_command = per_server.setdefault(command, {})
+            if len(per_command) >= DECISION_CACHE_SIZE:
+                per_command.clear()
+            per_command[key] = decision
+
+        if stats is not None:
+            stats.record(decision, cache_hit, start, time.perf_counter())
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("uid {} has perm: {} ({})".format(
+                ctx.message.author.id, decision[0], decision[1]))
+        return decision[0]
+
+    def _compile_permission(self, command, server, channel, author_roles):
+        """Returns (has_perm, rule) where rule names what decided it:
+            a lock type, "channel", "role" or "default"
+        """
+        debug = log.isEnabledFor(logging.DEBUG)
+        lock = self._lock_type(command, server, channel)
+        if lock is not None:
+            if debug:
+                log.debug("{} {} locked for chanid {}".format(
+                    command, lock, channel.id))
+            return False, lock + " lock"
+
+        shard = self._get_shard(server)
         try:
-            per_server = per_command[server.id]
-        except KeyError:
+            per_server = shard["COMMANDS"][command]
+        except (TypeError, KeyError):
             # In this case the server is not in the perms we want to check
             #   therefore we're just gonna assume the default "allow"
-            log.debug("sid {} not found for command {}".format(server.id,
-                                                               command))
-            return True
+            if debug:
+                log.debug("sid {} not found for command {}".format(
+                    server.id, command))
+            return True, "default"
 
         channel_perm_dict = per_server["CHANNELS"]
         role_perm_dict = per_server["ROLES"]
 
         if channel.id not in channel_perm_dict:
             # Again, assume default "allow"
-            log.debug("chanid {} not found, chan_perm = True".format(
-                channel.id))
-            channel_perm = True
+            channel_perm = None
         else:
             # We know that an admin has set permission on this channel
-            if self._is_allow(channel_perm_dict[channel.id]):
-                log.debug("chanid {} found and allowed".format(channel.id))
-                channel_perm = True
-            else:
-                log.debug("chanid {} found and denied".format(channel.id))
-                channel_perm = False
-
-        for role in roles:
-            if role.id in role_perm_dict:
-                if self._is_allow(role_perm_dict[role.id]):
-                    log.debug("role {} found and allowed".format(role.id))
-                    role_perm = True
-                    break
-                else:
-                    log.debug("role {} found and denied".format(role.id))
-                    role_perm = False
-                    break
-        else:
-            # By doing this we let the channel perm override in the case of
-            #   no role perms being set.
-            log.debug("role not found, ignoring roles")
-            role_perm = None
+            channel_perm = self._is_allow(channel_perm_dict[channel.id])
+        if debug:
+            log.debug("chanid {} chan_perm = {}".format(channel.id,
+                                                        channel_perm))
+
+        # The highest of the author's roles with a perm set decides.
+        positions = self._get_role_positions(server)
+        perm_roles = [r for r in author_roles if r.id in role_perm_dict]
+        if perm_roles:
+            top_role = max(perm_roles,
+                           key=lambda r: positions.get(r.id, r.position))
+            role_perm = self._is_allow(role_perm_dict[top_role.id])
+            if debug:
+                log.debug("role {} found, role_perm = {}".format(
+                    top_role.id, role_perm))
+            return role_perm, "role"
+
+        # By doing this we let the channel perm override in the case of
+        #   no role perms being set.
+        if channel_perm is None:
+            return True, "default"
+        return channel_perm, "channel"
+
+    def _rule_channel(self, server, value):
+        value = str(value).lstrip("#")
+        channel = discord.utils.get(server.channels, id=value) or \
+            discord.utils.get(server.channels, name=value)
+        if channel is None:
+            raise ValueError("channel {} not found".format(value))
+        return channel
+
+    def _rule_commands(self, name):
+        """
+        Dotted names for a command, or for every command in a cog.
+        """
+        try:
+            cmd_obj = self._get_command(name)
+        except BadCommand:
+            if name not in self.bot.cogs:
+                raise ValueError("no command or cog named {}".format(name))
+            return [self._dotted(c)
+                    for c in set(self.bot.commands.values())
+                    if c.cog_name == name]
+        return [self._dotted(cmd_obj)]
+
+    def _rule_role(self, server, value):
+        value = str(value)
+        role = discord.utils.get(server.roles, id=value)
+        if role is None:
+            try:
+                role = self._get_role(server.roles, value)
+            except RoleNotFound:
+                raise ValueError("role {} not found".format(value))
+        return role
 
-        is_locked = self._is_locked(command, server, channel)
+    def _save_perms(self, server=None):
+        """
+        Marks a server's perms, or the global locks if no server is given, as
+            changed. Bursts of edits are collapsed into a single write once
+            things have been quiet for SAVE_DELAY seconds.
+        """
+        self._dirty.add(getattr(server, "id", server))
 
-        has_perm = ((role_perm is None and channel_perm) or
-                    (role_perm is True)) and not is_locked
-        log.debug("uid {} has perm: {}".format(ctx.message.author.id,
-                                               has_perm))
-        return has_perm
+        now = time.monotonic()
+        if self._dirty_since is None:
+            self._dirty_since = now
 
-    def _save_perms(self):
-        dataIO.save_json('data/permissions/perms.json', self.perms_we_want)
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+
+        delay = min(SAVE_DELAY, self._dirty_since + SAVE_MAX_DELAY - now)
+        self._save_handle = self.bot.loop.call_later(max(delay, 0),
+                                                     self._flush_perms)
 
     async def _set_channel(self, command, server, channel, allow):
         try:
-            cmd_dot_name = command.qualified_name.replace(" ", ".")
+            cmd_dot_name = self._dotted(command)
         except AttributeError:
             # If we pass a cog name in as command
             cmds = list(filter(lambda c: c.cog_name == command,
@@ -502,21 +1170,12 @@ class Permissions:
                 await self._set_channel(cmd, server, channel, allow)
             return
 
-        if allow:
-            allow = "+"
-        else:
-            allow = "-"
-
-        await self.perm_lock.acquire()
-        if cmd_dot_name not in self.perms_we_want:
-            self.perms_we_want[cmd_dot_name] = {}
-        if server.id not in self.perms_we_want[cmd_dot_name]:
-            self.perms_we_want[cmd_dot_name][server.id] = \
-                {"CHANNELS": {}, "ROLES": {}}
-        self.perms_we_want[cmd_dot_name][server.id]["CHANNELS"][channel.id] = \
-            "{}{}".format(allow, cmd_dot_name)
-        self.perm_lock.release()
-        self._save_perms()
+        with (await self.perm_lock):
+            shard = self._copy_shard(server)
+            self._put_rule(shard, cmd_dot_name, "CHANNELS", channel.id, allow)
+            self._publish_shard(server, shard)
+            self._invalidate_decisions(server, cmd_dot_name)
+        self._save_perms(server)
 
     async def _set_permission(self, command, server, channel=None, role=None,
                               allow=True):
@@ -529,7 +1188,7 @@ class Permissions:
     async def _set_role(self, command, server, role, allow):
         """Command can be a command object or cog name (string)"""
         try:
-            cmd_dot_name = command.qualified_name.replace(" ", ".")
+            cmd_dot_name = self._dotted(command)
         except AttributeError:
             # If we pass a cog name in as command
             cmds = list(filter(lambda c: c.cog_name == command,
@@ -537,20 +1196,48 @@ class Permissions:
             for cmd in cmds:
                 await self._set_role(cmd, server, role, allow)
         else:
-            if allow:
-                allow = "+"
-            else:
-                allow = "-"
-            await self.perm_lock.acquire()
-            if cmd_dot_name not in self.perms_we_want:
-                self.perms_we_want[cmd_dot_name] = {}
-            if server.id not in self.perms_we_want[cmd_dot_name]:
-                self.perms_we_want[cmd_dot_name][server.id] = \
-                    {"CHANNELS": {}, "ROLES": {}}
-            self.perms_we_want[cmd_dot_name][server.id]["ROLES"][role.id] = \
-                "{}{}".format(allow, cmd_dot_name)
-            self.perm_lock.release()
-            self._save_perms()
+            with (await self.perm_lock):
+                shard = self._copy_shard(server)
+                self._put_rule(shard, cmd_dot_name, "ROLES", role.id, allow)
+                self._publish_shard(server, shard)
+                self._invalidate_decisions(server, cmd_dot_name)
+            self._save_perms(server)
+
+    def _shard_commands(self, shard):
+        ret = set(shard["COMMANDS"])
+        ret.update(shard["LOCKS"]["SERVER"])
+        for chan_locks in shard["LOCKS"]["CHANNELS"].values():
+            ret.update(chan_locks)
+        return ret
+
+    def _shard_empty(self, shard):
+        return not (shard["COMMANDS"] or shard["LOCKS"]["SERVER"] or
+                    shard["LOCKS"]["CHANNELS"])
+
+    def _shard_path(self, sid):
+        return os.path.join(SERVERS_DIR, "{}.json".format(sid))
+
+    def _top_role_position(self, positions, roles):
+        return max((positions.get(r.id, r.position) for r in roles),
+                   default=-1)
+
+    def _write_perms(self, writes):
+        # Runs in the save executor. Write then rename so a crash mid-write
+        #   never leaves a truncated file behind.
+        for path, data in writes:
+            if data is None:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+
+            tmp_path = "{}.tmp".format(path)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self._dump(data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
 
     @commands.group(pass_context=True, no_pm=True)
     @checks.serverowner_or_permissions(manage_roles=True)
@@ -630,16 +1317,28 @@ class Permissions:
         await self.bot.say("Channel {} permissions for {} reset.".format(
             channel.mention, command))
 
+    @p.command(pass_context=True, name="export")
+    async def p_export(self, ctx):
+        """Exports this server's permissions as a rule file
+
+        The file can be fed back to `p import` here or on another server."""
+        server = ctx.message.server
+        data = json.dumps(self._export_rules(server), indent=4)
+        fp = io.BytesIO(data.encode('utf-8'))
+        await self.bot.upload(fp, filename="perms-{}.json".format(server.id))
+
     @p.command(pass_context=True)
     async def info(self, ctx, command):
         """Gives current info about permissions on your server"""
         server = ctx.message.server
         channel = ctx.message.channel
-        if command not in self.perms_we_want:
+        shard = self._get_shard(server)
+        has_entry = shard is not None and command in shard["COMMANDS"]
+        if not has_entry and command not in self._perm_commands():
             await self.bot.say("No permissions have been set up for that"
                                " command")
             return
-        elif server.id not in self.perms_we_want[command]:
+        elif not has_entry and not self._is_locked(command, server, channel):
             await self.bot.say("No permissions have been set up for this"
                                " server.")
             return
@@ -664,6 +1363,54 @@ class Permissions:
         msg = tabulate(data, headers=headers, tablefmt='psql')
         await self.bot.say(box(msg))
 
+    @p.command(pass_context=True, name="import")
+    async def p_import(self, ctx, *, rules=None):
+        """Applies a rule file to this server in one go
+
+        Attach a JSON file (like the one `p export` gives you) or paste the
+        JSON after the command. Each rule looks like one of:
+            {"command": "playlist.add", "channel": "music", "allow": true}
+            {"command": "Audio", "role": "DJ", "allow": false}
+            {"command": "playlist.add", "lock": "server"}
+            {"command": "playlist.add", "lock": "channel", "channel": "music"}
+
+        Nothing is applied if any rule is invalid."""
+        server = ctx.message.server
+        if ctx.message.attachments:
+            try:
+                rules = await self._fetch_attachment(
+                    ctx.message.attachments[0]["url"])
+            except Exception:
+                await self.bot.say("Couldn't download that file.")
+                return
+        elif rules is None:
+            await send_cmd_help(ctx)
+            return
+        else:
+            # Allow the JSON to be wrapped in a code block
+            rules = rules.strip("`")
+            if rules.startswith("json"):
+                rules = rules[len("json"):]
+
+        start = time.perf_counter()
+        try:
+            data = json.loads(rules)
+        except ValueError:
+            await self.bot.say("That isn't valid JSON.")
+            return
+
+        ops, errors = self._parse_rules(server, data)
+        if errors:
+            await self.bot.say(box("\n".join(errors[:20])) +
+                               "Nothing was applied.")
+            return
+
+        await self._apply_rules(server, ops)
+        elapsed = (time.perf_counter() - start) * 1000
+        count = len(data["rules"] if isinstance(data, dict) else data)
+        await self.bot.say("Applied {} rules ({} permission entries) in"
+                           " {:.1f}ms.".format(count, len(ops), elapsed))
+
     @p.group(pass_context=True, invoke_without_command=True)
     async def lock(self, ctx, command):
         """Globally locks a command from being used by anyone but owner
@@ -798,6 +1545,61 @@ class Permissions:
 
         await self.bot.say("{} permission reset.".format(role.name))
 
+    @p.group(pass_context=True, name="stats", invoke_without_command=True)
+    async def p_stats(self, ctx):
+        """Shows how permission checks have been going since the last reset
+
+        Counts are for the whole bot, not just this server."""
+        stats = self.check_stats
+        if stats is None:
+            await self.bot.say("Stats are off, turn them on with"
+                               " `p stats toggle`.")
+            return
+        elif stats.checks == 0:
+            await self.bot.say("No permission checks yet.")
+            return
+
+        uptime = max(time.perf_counter() - stats.started, 1)
+        msg = ("Checks: {} ({:.2f}/s lately, {:.2f}/s overall)\n"
+               "Cache hit rate: {:.1%}\n"
+               "Eval time: p50 {:.1f}us, p99 {:.1f}us (last {} checks)\n\n"
+               "".format(stats.checks, stats.rate(), stats.checks / uptime,
+                         stats.cache_hits / stats.checks,
+                         stats.percentile(50) * 1e6,
+                         stats.percentile(99) * 1e6, len(stats.timings)))
+
+        rules = sorted(set(stats.allowed) | set(stats.denied))
+        data = [(rule, stats.allowed[rule], stats.denied[rule])
+                for rule in rules]
+        msg += tabulate(data, headers=["Decided by", "Allowed", "Denied"],
+                        tablefmt='psql')
+        await self.bot.say(box(msg))
+
+    @p_stats.command(pass_context=True, name="reset")
+    async def stats_reset(self, ctx):
+        """Zeroes the permission check stats"""
+        author = ctx.message.author
+        if author.id != self.bot.settings.owner:
+            return
+
+        if self.check_stats is not None:
+            self.check_stats = CheckStats()
+        await self.bot.say("Permission stats reset.")
+
+    @p_stats.command(pass_context=True, name="toggle")
+    async def stats_toggle(self, ctx):
+        """Turns collecting permission check stats on or off"""
+        author = ctx.message.author
+        if author.id != self.bot.settings.owner:
+            return
+
+        if self.check_stats is None:
+            self.check_stats = CheckStats()
+            await self.bot.say("Permission stats are now on.")
+        else:
+            self.check_stats = None
+            await self.bot.say("Permission stats are now off.")
+
     @p.group(pass_context=True, invoke_without_command=True)
     async def unlock(self, ctx, command):
         """Globally unlocks a command from being used by anyone but owner
@@ -860,30 +1662,73 @@ class Permissions:
         if cmd and cmd.qualified_name.split(" ")[0] == "p":
             await self._error_responses(error, ctx)
 
-    async def add_checks_to_all(self):
-        while self == self.bot.get_cog('Permissions'):
-            perms_we_want = copy.copy(self.perms_we_want)
-            for cmd_dot in perms_we_want:
-                try:
-                    cmd_obj = self._get_command(cmd_dot)
-                    check_obj = discord.utils.find(
-                        lambda c: type(c).__name__ == "Check", cmd_obj.checks)
-                except BadCommand:
-                    # Command is no longer loaded/found
-                    pass
-                except AttributeError:
-                    # cmd_obj got to be None somehow so we'll assume it's not
-                    #   loaded
-                    pass
-                else:
-                    if check_obj is None:
-                        log.debug("Check object not found in {},"
-                                  " adding".format(cmd_dot))
-                        cmd_obj.checks.append(Check(cmd_dot))
-            await asyncio.sleep(0.5)
+    # Role positions decide which role perm wins, any change to the role list
+    #   of a server can flip a compiled decision.
+
+    async def role_created(self, role):
+        positions = self.role_positions.get(role.server.id)
+        if positions is not None:
+            positions[role.id] = role.position
+        self._invalidate_decisions(role.server)
+
+    async def role_deleted(self, role):
+        positions = self.role_positions.get(role.server.id)
+        if positions is not None:
+            positions.pop(role.id, None)
+        self._invalidate_decisions(role.server)
+
+    async def role_updated(self, before, after):
+        positions = self.role_positions.get(after.server.id)
+        if positions is not None:
+            positions[after.id] = after.position
+        self._invalidate_decisions(after.server)
+
+    async def channel_changed(self, *channels):
+        server = getattr(channels[-1], "server", None)
+        if server is not None:
+            self._invalidate_decisions(server)
+
+    async def ready(self):
+        self._load_servers()
+
+    async def server_joined(self, server):
+        self._get_shard(server)
+
+    async def server_removed(self, server):
+        self.role_positions.pop(server.id, None)
+        self._invalidate_decisions(server)
+        # Unsaved edits keep the server around until they're written
+        if server.id not in self._dirty:
+            self.server_perms.pop(server.id, None)
+
+    def add_checks_to_all(self, root=None):
+        """
+        Installs a Check on every command we have permissions for, or only
+            on those under the top level command `root`.
+
+        Returns the number of checks installed.
+        """
+        installed = 0
+        for cmd_dot in self._perm_commands():
+            if root is not None and cmd_dot.split('.')[0] != root:
+                continue
+            if self._install_check(cmd_dot):
+                installed += 1
+
+        if installed:
+            log.info("installed {} permission checks".format(installed))
+        return installed
 
 
 def setup(bot):
     n = Permissions(bot)
     bot.add_cog(n)
     bot.add_listener(n.command_error, "on_command_error")
+    bot.add_listener(n.role_created, "on_server_role_create")
+    bot.add_listener(n.role_deleted, "on_server_role_delete")
+    bot.add_listener(n.role_updated, "on_server_role_update")
+    bot.add_listener(n.channel_changed, "on_channel_delete")
+    bot.add_listener(n.channel_changed, "on_channel_update")
+    bot.add_listener(n.ready, "on_ready")
+    bot.add_listener(n.server_joined, "on_server_join")
+    bot.add_listener(n.server_removed, "on_server_remove")
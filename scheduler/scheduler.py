@@ -6,16 +6,156 @@ from cogs.utils.chat_formatting import *
 
 import logging
 import os
-import asyncio
+import bisect
+import heapq
+import itertools
 import time
+import zlib
+from datetime import datetime, timedelta, timezone
 from random import randint
-from math import ceil
+from math import ceil, floor
+
+try:
+    import pytz
+except:
+    pytz = None
 
 log = logging.getLogger("red.scheduler")
 log.setLevel(logging.INFO)
 
+# SPREAD: repeating events run up to this many seconds after their time, by
+#   an amount fixed per event, so ones made together don't all go off at once.
+# Runs each channel / the whole bot may start per second, and how many may
+#   start back to back after a quiet spell. Runs over budget wait their turn.
+#   `scheduler spread` and `scheduler budget` change these.
+DEFAULT_SETTINGS = {'SPREAD': 0, 'CHANNEL_RATE': 1.0, 'CHANNEL_BURST': 5,
+                    'GLOBAL_RATE': 10.0, 'GLOBAL_BURST': 20}
+
+
+class Cron:
+    """A compiled five field cron expression: minute hour day month weekday.
+
+    Each field becomes a sorted tuple of the values it allows, so finding the
+    next match skips straight to the next allowed month, day, hour and minute
+    instead of trying every minute in between.
+    """
+    __slots__ = ('expression', 'minutes', 'hours', 'days', 'months',
+                 'weekdays', 'any_day', 'any_weekday')
+
+    NAMES = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+             'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+             'sun': 0, 'mon': 1, 'tue': 2, 'wed': 3, 'thu': 4, 'fri': 5,
+             'sat': 6}
+
+    def __init__(self, expression):
+        fields = expression.lower().split()
+        if len(fields) != 5:
+            raise ValueError('a cron expression has five fields')
+        self.expression = ' '.join(fields)
+        self.minutes = self._parse(fields[0], 0, 59)
+        self.hours = self._parse(fields[1], 0, 23)
+        self.days = self._parse(fields[2], 1, 31)
+        self.months = self._parse(fields[3], 1, 12)
+        # 0 and 7 are both Sunday
+        self.weekdays = tuple(sorted(set(d % 7 for d in
+                                         self._parse(fields[4], 0, 7))))
+        # Like every cron, when both day fields are given either may match
+        self.any_day = fields[2].startswith('*')
+        self.any_weekday = fields[4].startswith('*')
+        # Catches things like "0 0 31 2 *" that never happen
+        self.next_after(datetime(2000, 1, 1))
+
+    def _parse(self, field, low, high):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (self._value(v) for v in part.split('-', 1))
+            else:
+                start = end = self._value(part)
+                if step != 1:
+                    end = high
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('{} is out of range'.format(field))
+            values.update(range(start, end + 1, step))
+        return tuple(sorted(values))
+
+    def _value(self, value):
+        return self.NAMES[value] if value in self.NAMES else int(value)
+
+    def _day_matches(self, day):
+        weekday = (day.weekday() + 1) % 7
+        in_days = day.day in self.days
+        in_weekdays = weekday in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, after):
+        """The first naive datetime matching this expression that comes
+        after `after`, to the minute.
+        """
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Leap days can make a match up to eight years out
+        limit = t.year + 8
+        while t.year <= limit:
+            if t.month not in self.months:
+                i = bisect.bisect_left(self.months, t.month)
+                if i == len(self.months):
+                    t = datetime(t.year + 1, self.months[0], 1)
+                else:
+                    t = datetime(t.year, self.months[i], 1)
+                continue
+            if not self._day_matches(t):
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            if t.hour not in self.hours:
+                i = bisect.bisect_left(self.hours, t.hour)
+                if i == len(self.hours):
+                    t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                else:
+                    t = t.replace(hour=self.hours[i], minute=0)
+                continue
+            if t.minute not in self.minutes:
+                i = bisect.bisect_left(self.minutes, t.minute)
+                if i == len(self.minutes):
+                    t = t.replace(minute=0) + timedelta(hours=1)
+                else:
+                    t = t.replace(minute=self.minutes[i])
+                continue
+            return t
+        raise ValueError('{} never matches'.format(self.expression))
+
+
+# Events on the same expression share one Cron
+_crons = {}
+
+
+def compile_cron(expression):
+    if expression not in _crons:
+        _crons[expression] = Cron(expression)
+    return _crons[expression]
+
+
+def get_timezone(name):
+    """tzinfo for a zone name like 'Europe/London', UTC for None. Raises
+    ValueError without pytz and pytz.UnknownTimeZoneError for a bad name.
+    """
+    if name is None:
+        return timezone.utc
+    if pytz is None:
+        raise ValueError('timezones need pytz')
+    return pytz.timezone(name)
+
 
 class Event:
+    __slots__ = ('name', 'channel', 'server', 'author', 'command',
+                 'timedelta', 'repeat', 'starttime', 'key', 'cron',
+                 'timezone', 'tzinfo', 'seed')
+
     def __init__(self, data=None):
         self.name = data.pop('name')
         self.channel = data.pop('channel')
@@ -25,33 +165,97 @@ class Event:
         self.timedelta = data.pop('timedelta')
         self.repeat = data.pop('repeat')
         self.starttime = data.pop('starttime', None)
-
-    def __lt__(self, other):
-        my_sig = "{}-{}-{}-{}".format(self.timedelta, self.name,
-                                      self.starttime, self.channel)
-        other_sig = "{}-{}-{}-{}".format(other.timedelta, other.name,
-                                         other.starttime, other.channel)
-        return hash(my_sig) < hash(other_sig)
+        self.key = (self.server, self.name)
+        # Same on every run, unlike hash()
+        self.seed = zlib.crc32('{}/{}'.format(*self.key).encode())
+        self.cron = data.pop('cron', None)
+        self.timezone = data.pop('timezone', None)
+        if self.cron is not None:
+            self.cron = compile_cron(self.cron)
+            try:
+                self.tzinfo = get_timezone(self.timezone)
+            except ValueError:
+                log.warning('"{}" runs in {} but pytz is not installed, using'
+                            ' UTC'.format(self.name, self.timezone))
+                self.tzinfo = timezone.utc
+            except pytz.UnknownTimeZoneError:
+                log.warning('"{}" runs in unknown timezone {}, using'
+                            ' UTC'.format(self.name, self.timezone))
+                self.tzinfo = timezone.utc
+
+    def next_run(self, after):
+        """When a cron event next runs after the `after` timestamp, going by
+        the wall clock in its timezone.
+        """
+        tz = self.tzinfo
+        local = datetime.fromtimestamp(after, tz).replace(tzinfo=None)
+        while True:
+            local = self.cron.next_after(local)
+            if hasattr(tz, 'localize'):
+                # pytz zones need this to get daylight saving right
+                fut = tz.normalize(tz.localize(local)).timestamp()
+            else:
+                fut = local.replace(tzinfo=tz).timestamp()
+            # The hour clocks go back repeats could put it in the past
+            if fut > after:
+                return fut
 
 
 class Scheduler:
     """Schedules commands to run every so often.
 
     Times are formed as follows: 1s, 2m, 3h, 5d, 1w
+    `scheduler cron` and `scheduler daily` run at set times of day instead.
     """
 
     def __init__(self, bot):
         self.bot = bot
         self.events = fileIO('data/scheduler/events.json', 'load')
-        self.queue = asyncio.PriorityQueue(loop=self.bot.loop)
-        self.queue_lock = asyncio.Lock()
-        self.to_kill = {}
+        # {server id: timezone name} that cron events are created in
+        self.timezones = fileIO('data/scheduler/timezones.json', 'load')
+        self.settings = DEFAULT_SETTINGS.copy()
+        self.settings.update(fileIO('data/scheduler/settings.json', 'load'))
+        # Heap of (time to run, sequence, Event), and the timer that goes off
+        #   when the first of them is due. Nothing is scheduled while it's
+        #   empty. The sequence breaks ties in the order events were put in,
+        #   so Events themselves never get compared.
+        self.queue = []
+        self.sequence = itertools.count()
+        self.timer = None
+        # The Event each (server id, name) runs. Heap entries whose Event
+        #   isn't in here were removed or replaced, and get skipped and
+        #   thrown away when they come up. `dead` counts them.
+        self.live = {}
+        self.dead = 0
+        # Loop times at which the next run may go out per channel id and
+        #   for the bot as a whole once its burst is used up, and the runs
+        #   that are waiting for that. {event key: TimerHandle}
+        self.channel_due = {}
+        self.global_due = 0
+        self.delayed = {}
         self._load_events()
 
+    def __unload(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for handle in self.delayed.values():
+            handle.cancel()
+        self.delayed = {}
+        self.queue = []
+        self.live = {}
+        self.dead = 0
+
     def save_events(self):
         fileIO('data/scheduler/events.json', 'save', self.events)
         log.debug('saved events:\n\t{}'.format(self.events))
 
+    def save_settings(self):
+        fileIO('data/scheduler/settings.json', 'save', self.settings)
+
+    def save_timezones(self):
+        fileIO('data/scheduler/timezones.json', 'save', self.timezones)
+
     def _load_events(self):
         # for entry in the self.events make an Event
         for server in self.events:
@@ -60,25 +264,132 @@ class Scheduler:
                 ret['server'] = server
                 ret.update(event)
                 e = Event(ret)
-                self.bot.loop.create_task(self._put_event(e))
+                self._put_event(e)
 
-    async def _put_event(self, event, fut=None, offset=None):
+    def _put_event(self, event, fut=None):
         if fut is None:
-            now = int(time.time())
-            if event.repeat:
-                diff = now - event.starttime
+            now = time.time()
+            if event.cron is not None:
+                fut = self._next_run(event, now)
+            elif event.repeat:
+                jitter = self._jitter(event)
+                diff = now - jitter - event.starttime
                 fut = ((ceil(diff / event.timedelta) * event.timedelta) +
-                       event.starttime)
+                       event.starttime + jitter)
             else:
                 fut = now + event.timedelta
-        if offset:
-            fut += offset
-        await self.queue.put((fut, event))
-        log.debug('Added "{}" to the scheduler queue at {}'.format(event.name,
-                                                                   fut))
+        if self.live.get(event.key, event) is not event:
+            self.dead += 1
+        self.live[event.key] = event
+        heapq.heappush(self.queue, (fut, next(self.sequence), event))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Added "{}" to the scheduler queue at {}'.format(
+                event.name, fut))
+        if self.queue[0][2] is event:
+            # Runs before whatever we were waiting for
+            self._set_timer()
+
+    def _jitter(self, event):
+        spread = self.settings['SPREAD']
+        if not spread or not event.repeat:
+            return 0
+        if event.cron is None:
+            spread = min(spread, event.timedelta)
+        return event.seed % int(spread * 1000) / 1000
+
+    def _next_run(self, event, after):
+        """When a repeating event runs next after `after`"""
+        jitter = self._jitter(event)
+        if event.cron is not None:
+            return event.next_run(after - jitter) + jitter
+        # If we slept through some runs, don't make them all up now
+        runs = floor((after - jitter - event.starttime) / event.timedelta)
+        return event.starttime + jitter + (runs + 1) * event.timedelta
+
+    def _is_live(self, event):
+        return self.live.get(event.key) is event
+
+    def _set_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.queue:
+            delay = max(0, self.queue[0][0] - time.time())
+            self.timer = self.bot.loop.call_later(delay, self._run_due)
+
+    def _run_due(self):
+        """Runs every event that is due and waits for the next one"""
+        self.timer = None
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            fut, _, event = heapq.heappop(self.queue)
+            if not self._is_live(event):
+                self.dead -= 1
+                continue
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('running "{}" {:.3f}s after it was due'.format(
+                    event.name, now - fut))
+            if event.repeat:
+                heapq.heappush(self.queue, (self._next_run(event, now),
+                                            next(self.sequence), event))
+            else:
+                del self.live[event.key]
+                self.events.get(event.server, {}).pop(event.name, None)
+                self.save_events()
+            self._dispatch(event)
+        self._set_timer()
+
+    def _dispatch(self, event):
+        """Runs the event now if the budgets allow it, otherwise as soon as
+        they do
+        """
+        if event.key in self.delayed:
+            log.debug('"{}" is still waiting for its last run, skipping'
+                      ''.format(event.name))
+            return
+        now = self.bot.loop.time()
+        at = self._reserve(event.channel, now)
+        if at <= now:
+            self._run(event)
+        else:
+            log.debug('"{}" over budget, running in {:.1f}s'.format(
+                event.name, at - now))
+            self.delayed[event.key] = self.bot.loop.call_later(
+                at - now, self._run_delayed, event)
+
+    def _reserve(self, channel, now):
+        """Takes a run out of the channel's and the global budget and
+        returns when it may go out. Budgets are token buckets, kept as the
+        time the bucket is next empty.
+        """
+        settings = self.settings
+        channel_gap = 1 / settings['CHANNEL_RATE']
+        global_gap = 1 / settings['GLOBAL_RATE']
+        channel_due = self.channel_due.get(channel, now)
+        at = max(now,
+                 channel_due - (settings['CHANNEL_BURST'] - 1) * channel_gap,
+                 self.global_due - (settings['GLOBAL_BURST'] - 1) * global_gap)
+        self.channel_due[channel] = max(channel_due, at) + channel_gap
+        self.global_due = max(self.global_due, at) + global_gap
+
+        if len(self.channel_due) > 1000:
+            # Channels whose bucket has filled back up
+            self.channel_due = {c: due for c, due in self.channel_due.items()
+                                if due > now}
+        return at
+
+    def _run_delayed(self, event):
+        del self.delayed[event.key]
+        self._run(event)
+
+    def _run(self, event):
+        try:
+            self.run_coro(event)
+        except Exception:
+            log.exception('could not run "{}"'.format(event.name))
 
     async def _add_event(self, name, command, dest_server, dest_channel,
-                         author, timedelta, repeat=False):
+                         author, timedelta, repeat=False, cron=None):
         if isinstance(dest_server, discord.Server):
             dest_server = dest_server.id
         if isinstance(dest_channel, discord.Channel):
@@ -95,30 +406,51 @@ class Scheduler:
                       'command': command,
                       'timedelta': timedelta,
                       'repeat': repeat}
+        if cron is not None:
+            event_dict['cron'] = cron
+            event_dict['timezone'] = self.timezones.get(dest_server)
 
         log.debug('event dict:\n\t{}'.format(event_dict))
 
-        now = int(time.time())
+        now = time.time()
         event_dict['starttime'] = now
         self.events[dest_server][name] = event_dict.copy()
 
         event_dict['server'] = dest_server
         e = Event(event_dict.copy())
-        await self._put_event(e)
+        # A run of the event this replaces may still be held back by budget
+        self._cancel_delayed(e.key)
+        if repeat and cron is None:
+            # Runs straight away, then every timedelta after
+            self._put_event(e, now + self._jitter(e))
+        else:
+            self._put_event(e)
 
         self.save_events()
 
-    async def _remove_event(self, name, server):
-        await self.queue_lock.acquire()
-        events = []
-        while self.queue.qsize() != 0:
-            time, event = await self.queue.get()
-            if not (name == event.name and server.id == event.server):
-                events.append((time, event))
+    def _cancel_delayed(self, key):
+        handle = self.delayed.pop(key, None)
+        if handle is not None:
+            handle.cancel()
 
-        for event in events:
-            await self.queue.put(event)
-        self.queue_lock.release()
+    async def _remove_event(self, name, server):
+        self._cancel_delayed((server.id, name))
+        if self.live.pop((server.id, name), None) is None:
+            return
+        self.dead += 1
+        if self.dead > len(self.queue) // 2:
+            # Mostly tombstones, cheaper to rebuild than to keep popping them
+            self.queue = [entry for entry in self.queue
+                          if self._is_live(entry[2])]
+            heapq.heapify(self.queue)
+            self.dead = 0
+        elif self._is_live(self.queue[0][2]):
+            return
+        while self.queue and not self._is_live(self.queue[0][2]):
+            heapq.heappop(self.queue)
+            self.dead -= 1
+        # The timer may be waiting on the one that's gone
+        self._set_timer()
 
     @commands.group(no_pm=True, pass_context=True)
     @checks.mod_or_permissions(manage_messages=True)
@@ -182,6 +514,119 @@ class Scheduler:
         await self.bot.say('"{}" will run "{}" every {}s'.format(name, command,
                                                                  s))
 
+    @scheduler.command(pass_context=True, name="cron")
+    async def _scheduler_cron(self, ctx, name, expression, *, command):
+        """Add a command to run on a cron schedule.
+
+        The expression has to be quoted: minute hour day month weekday,
+        e.g. "0 9 * * 1-5" is 9am on weekdays. Times are in this server's
+        timezone, see `scheduler timezone`.
+        """
+        await self._add_cron(ctx, name, expression, command)
+
+    @scheduler.command(pass_context=True, name="daily")
+    async def _scheduler_daily(self, ctx, name, at, *, command):
+        """Add a command to run every day at [at], e.g. 18:30.
+
+        Times are in this server's timezone, see `scheduler timezone`.
+        """
+        try:
+            hour, minute = (int(t) for t in at.split(':'))
+        except ValueError:
+            await self.bot.send_cmd_help(ctx)
+            return
+        await self._add_cron(ctx, name, '{} {} * * *'.format(minute, hour),
+                             command)
+
+    async def _add_cron(self, ctx, name, expression, command):
+        channel = ctx.message.channel
+        server = ctx.message.server
+        author = ctx.message.author
+        name = name.lower()
+        try:
+            cron = compile_cron(expression)
+        except (ValueError, KeyError):
+            await self.bot.reply('that isn\'t a cron expression I understand.'
+                                 ' It goes minute hour day month weekday,'
+                                 ' like "0 9 * * 1-5".')
+            return
+        log.info('add {} "{}" to {} on {} at "{}"'.format(
+            name, command, channel.name, server.name, cron.expression))
+        await self._add_event(name, command, server, channel, author, 0, True,
+                              cron=cron.expression)
+        await self.bot.say('"{}" will run "{}" at "{}" ({})'.format(
+            name, command, cron.expression,
+            self.timezones.get(server.id, 'UTC')))
+
+    @scheduler.command(pass_context=True, name="timezone")
+    async def _scheduler_timezone(self, ctx, timezone=None):
+        """Sets the timezone new cron and daily events run in.
+
+        Use names like Europe/London or America/New_York.
+        """
+        server = ctx.message.server
+        if timezone is None:
+            await self.bot.say('Cron events here use {}.'.format(
+                self.timezones.get(server.id, 'UTC')))
+            return
+        if pytz is None:
+            await self.bot.say('You need to run `pip3 install pytz`.')
+            return
+        try:
+            get_timezone(timezone)
+        except pytz.UnknownTimeZoneError:
+            await self.bot.say('I don\'t know that timezone.')
+            return
+        self.timezones[server.id] = timezone
+        self.save_timezones()
+        await self.bot.say('New cron events here will use {}.'.format(
+            timezone))
+
+    @scheduler.command(pass_context=True, name="spread")
+    async def _scheduler_spread(self, ctx, seconds: int=None):
+        """Spreads repeating events over up to [seconds] after their time.
+
+        Each event always gets the same delay, so events set up together
+        stop going off all at once. 0 turns it off."""
+        if ctx.message.author.id != self.bot.settings.owner:
+            return
+        if seconds is not None:
+            if seconds < 0:
+                await self.bot.say('That needs to be 0 or more.')
+                return
+            self.settings['SPREAD'] = seconds
+            self.save_settings()
+        await self.bot.say('Repeating events are spread over {}s.'.format(
+            self.settings['SPREAD']))
+
+    @scheduler.command(pass_context=True, name="budget")
+    async def _scheduler_budget(self, ctx, channel_rate: float=None,
+                                global_rate: float=None,
+                                channel_burst: int=None,
+                                global_burst: int=None):
+        """Sets how fast scheduled commands may run.
+
+        channel_rate: runs started per second in one channel
+        global_rate: runs started per second across the bot
+        channel_burst, global_burst: runs that may start back to back after
+        a quiet spell"""
+        if ctx.message.author.id != self.bot.settings.owner:
+            return
+        new = {'CHANNEL_RATE': channel_rate, 'GLOBAL_RATE': global_rate,
+               'CHANNEL_BURST': channel_burst, 'GLOBAL_BURST': global_burst}
+        new = {k: v for k, v in new.items() if v is not None}
+        if any(v <= 0 for v in new.values()) or \
+                any(v < 1 for k, v in new.items() if k.endswith('BURST')):
+            await self.bot.say('Those need to be positive.')
+            return
+        if new:
+            self.settings.update(new)
+            self.save_settings()
+        await self.bot.say('{CHANNEL_RATE}/s per channel in bursts of'
+                           ' {CHANNEL_BURST}, {GLOBAL_RATE}/s overall in'
+                           ' bursts of {GLOBAL_BURST}.'.format(
+                               **self.settings))
+
     @scheduler.command(pass_context=True, name="remove")
     async def _scheduler_remove(self, ctx, name):
         """Removes scheduled command from running.
@@ -198,8 +643,7 @@ class Scheduler:
         del self.events[server.id][name]
         await self._remove_event(name, server)
         self.save_events()
-        await self.bot.say('"{}" has successfully been removed but'
-                           ' it may run once more.'.format(name))
+        await self.bot.say('"{}" has successfully been removed.'.format(name))
 
     @scheduler.command(pass_context=True, name="list")
     async def _scheduler_list(self, ctx):
@@ -247,50 +691,6 @@ class Scheduler:
         # self.bot.loop.create_task(coro)
         self.bot.dispatch('message', fake_message)
 
-    async def queue_manager(self):
-        while self == self.bot.get_cog('Scheduler'):
-            await self.queue_lock.acquire()
-            if self.queue.qsize() != 0:
-                curr_time = int(time.time())
-                next_tuple = await self.queue.get()
-                next_time = next_tuple[0]
-                next_event = next_tuple[1]
-                diff = next_time - curr_time
-                diff = diff if diff >= 0 else 0
-                if diff < 30:
-                    log.debug('scheduling call of "{}" in {}s'.format(
-                        next_event.name, diff))
-                    fut = self.bot.loop.call_later(diff, self.run_coro,
-                                                   next_event)
-                    self.to_kill[next_time] = fut
-                    if next_event.repeat:
-                        await self._put_event(next_event, next_time,
-                                              next_event.timedelta)
-                    else:
-                        del self.events[next_event.server][next_event.name]
-                        self.save_events()
-                else:
-                    log.debug('Will run {} "{}" in {}s'.format(
-                        next_event.name, next_event.command, diff))
-                    await self._put_event(next_event, next_time)
-            self.queue_lock.release()
-
-            to_delete = []
-            for start_time, old_command in self.to_kill.items():
-                if time.time() > start_time + 30:
-                    old_command.cancel()
-                    to_delete.append(start_time)
-            for item in to_delete:
-                del self.to_kill[item]
-
-            await asyncio.sleep(5)
-        log.debug('manager dying')
-        while self.queue.qsize() != 0:
-            await self.queue.get()
-        while len(self.to_kill) != 0:
-            curr = self.to_kill.pop()
-            curr.cancel()
-
 
 def check_folder():
     if not os.path.exists('data/scheduler'):
@@ -298,15 +698,14 @@ def check_folder():
 
 
 def check_files():
-    f = 'data/scheduler/events.json'
-    if not os.path.exists(f):
-        fileIO(f, 'save', {})
+    for f in ('data/scheduler/events.json', 'data/scheduler/timezones.json',
+              'data/scheduler/settings.json'):
+        if not os.path.exists(f):
+            fileIO(f, 'save', {})
 
 
 def setup(bot):
     check_folder()
     check_files()
     n = Scheduler(bot)
-    loop = asyncio.get_event_loop()
-    loop.create_task(n.queue_manager())
     bot.add_cog(n)